@@ -25,14 +25,28 @@ the license in the LICENSE file.
 from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.api import datastore
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
 from google.appengine.datastore import entity_pb
 from google.appengine.runtime import apiproxy_errors
 
+import abc
 import cachepy
+import copy
+import cPickle as pickle
+import hashlib
+import itertools
 import logging
+import os
+import random
+import struct
+import threading
+import time
+import zlib
 
-from datetime import datetime,date
+from collections import OrderedDict
+from datetime import datetime,date,timedelta
 
 '''Constants for storage levels'''
 DATASTORE = 'datastore'
@@ -46,17 +60,129 @@ LIST = 'list'
 DICT = 'dict'
 NAME_DICT = 'name_dict'
 
+'''Constants for local cache storage modes'''
+LOCAL_MODEL = 'model' #Live model instances, fastest reads
+LOCAL_ENCODED = 'encoded' #Protobuf encoded models, smaller and decoded on read
+
 LOCAL_EXPIRATION = 300
 MEMCACHE_EXPIRATION = 0
 QUERY_EXPIRATION = 300
+'''Expiration of the tombstones pdb.get caches for keys that are not in datastore,
+0 keeps them until a pdb.put or pdb.delete of the key. None turns them off, 
+as models written with db.put would be answered with a tombstone until it expires'''
+TOMBSTONE_EXPIRATION = None
 
-none_filter  = lambda dict : [k for k,v in dict.iteritems() if v is None]
+'''Memcache misses are refilled by the request holding a lease on the key, 
+other requests poll memcache every LEASE_POLL_INTERVAL seconds for at most 
+LEASE_WAIT seconds before reading datastore themselves. A lease expires after 
+LEASE_EXPIRATION seconds if its holder never releases it'''
+LEASES = True
+LEASE_EXPIRATION = 10
+LEASE_WAIT = 1.0
+LEASE_POLL_INTERVAL = 0.05
+
+'''Cached entries within REFRESH_AHEAD seconds of their expiration are served
+and refreshed in the background, memcache entries by a deferred task and local
+cache entries when pdb.wait_all is called at the end of the request, which
+BatchMiddleware and RequestScopeMiddleware do. A thread queues at most 
+REFRESH_QUEUE_SIZE local refreshes, other keys expire as usual.
+None turns refresh-ahead off'''
+REFRESH_AHEAD = None
+REFRESH_QUEUE_SIZE = 1000
+
+'''pdb.iget reads keys in windows of IGET_BATCH_SIZE keys'''
+IGET_BATCH_SIZE = 500
+
+'''pdb.put with _write_behind writes models to cache layers right away and to 
+datastore when the WRITE_BEHIND_WINDOW seconds long window they were written in
+is flushed, so the writes of a key in the same window become one datastore write.
+Latest versions and the journal of written keys are kept in memcache for
+WRITE_BEHIND_EXPIRATION seconds, models memcache evicts before a flush are lost.
+Windows are flushed WRITE_BEHIND_GRACE seconds after they end, so writers that 
+picked a window just before it ended can journal into it. A writer that finds 
+its window already flushed writes to datastore itself'''
+WRITE_BEHIND = False
+WRITE_BEHIND_WINDOW = 10
+WRITE_BEHIND_EXPIRATION = 3600
+WRITE_BEHIND_GRACE = 5
+
+'''pdb.Counter increments are buffered locally for COUNTER_BUFFER_TIME seconds,
+added to memcache and folded into one of COUNTER_SHARDS datastore shards 
+every COUNTER_FOLD_INTERVAL seconds. Sums of shards are cached in memcache for
+COUNTER_SUM_EXPIRATION seconds, increments memcache evicts before a fold are lost.
+Buffers older than COUNTER_BUFFER_TIME are sent by the next pdb call of the 
+instance and by pdb.wait_all, increments still buffered when an instance shuts
+down are lost'''
+COUNTER_SHARDS = 20
+COUNTER_BUFFER_TIME = 1.0
+COUNTER_FOLD_INTERVAL = 10
+COUNTER_SUM_EXPIRATION = 60
+
+'''pdb.put skips pdb.Model instances whose datastore values haven't changed since
+they were loaded or put, when datastore is one of the target storage layers.
+Models are only fingerprinted while it is on, a pdb.delete of a kind in the
+instance invalidates the fingerprints of that kind taken before it'''
+SKIP_UNCHANGED = False
+
+'''Local storage mode for all kinds, LOCAL_KIND_MODES overrides it by kind name'''
+LOCAL_MODE = LOCAL_MODEL
+LOCAL_KIND_MODES = {}
+'''Number of entities decoded from LOCAL_ENCODED storage kept, so reads of
+them skip decompressing and parsing the protobuf'''
+LOCAL_HOT_SET_SIZE = 100
+
+'''Number of canonical key strings, key paths and ids or names kept by the
+key caches in two generations of half the size, None turns them off'''
+KEY_CACHE_SIZE = 10000
+
+'''Serialized models longer than COMPRESSION_THRESHOLD bytes are compressed
+with zlib at COMPRESSION_LEVEL, None turns compression off. 
+COMPRESSION_KINDS overrides both by kind name with a (threshold,level) tuple'''
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 1
+COMPRESSION_KINDS = {}
+
+'''Memcache values longer than this are split in chunks stored under
+separate keys, memcache rejects items larger than 1MB'''
+MEMCACHE_CHUNK_SIZE = 1000000 - 50000
+
+'''Header bytes of serialized models. Values written before headers were 
+added start with a protobuf field tag, which is never 0x00 or 0x01'''
+_RAW_HEADER = '\x00'
+_ZLIB_HEADER = '\x01'
+'''Cached in place of a model that is confirmed missing from datastore'''
+_TOMBSTONE = '\x02'
+'''Header of the expiration timestamp memcache values are prefixed with'''
+_EXPIRY_HEADER = '\x03'
+_EXPIRY = struct.Struct('!d')
+
+_stats_lock = threading.Lock()
+_stats = {'local_tombstone_hits':0,
+          'memcache_tombstone_hits':0,
+          'tombstones_written':0,
+          'leases_granted':0,
+          'leases_waited':0,
+          'lease_timeouts':0,
+          'local_refreshes':0,
+          'memcache_refreshes':0,
+          'write_behind_puts':0,
+          'write_behind_writes':0,
+          'skipped_writes':0,
+          'retry_spilled':0,
+          'retry_written':0,
+          'retry_superseded':0,
+          'counter_folds':0,
+          'scope_hits':0}
+
+def _count(stat,value=1):
+  with _stats_lock:
+    _stats[stat] = _stats.get(stat,0) + value
 
-_dict_multi_get = lambda keys,dict : [v for (k,v) in dict.iteritems() if k in dict if v is not None]
+none_filter  = lambda dict : [k for k,v in dict.iteritems() if v is None]
 
-def _validate_storage(storage_list):
+def _validate_storage(storage_list,levels=ALL_LEVELS):
   for storage in storage_list:
-    if storage not in ALL_LEVELS:
+    if storage not in levels:
       raise StorageLayerError(storage)
     
 def _validate_cache(cache_list):
@@ -64,16 +190,88 @@ def _validate_cache(cache_list):
     if cache not in ALL_CACHE:
       raise CacheLayerError(cache)
 
+class _KeyCache(object):
+  '''Bounded cache of key normalization results, values are never None.
+  
+  Entries live in two generations. A lookup that finds an entry in the old
+  generation moves it to the new one and the old generation is dropped when 
+  the new one is full, so the most used keys stay without an LRU list.
+  Races between threads can only lose entries.
+  '''
+  def __init__(self):
+    self.clear()
+    
+  def get(self,key):
+    try:
+      return self.current[key]
+    except KeyError:
+      value = self.previous.get(key)
+      if value is not None:
+        self.set(key,value)
+      return value
+    
+  def set(self,key,value):
+    if KEY_CACHE_SIZE is None:
+      return
+    current = self.current
+    if len(current) >= KEY_CACHE_SIZE//2:
+      self.previous = current
+      self.current = current = {}
+    current[key] = value
+    
+  def clear(self):
+    self.current = {}
+    self.previous = {}
+
+'''Canonical key strings by key string or key path, and id or name by 
+canonical key string'''
+_key_strings = _KeyCache()
+_key_names = _KeyCache()
+
 def _key_str(param):
   '''Utility function that extracts a string key from a model or key instance'''
+  #Keys and models keep their encoded key, only strings have to be parsed
+  if isinstance(param,basestring):
+    key = _key_strings.get(param)
+    if key is not None:
+      return key
   try:
-    return str(db._coerce_to_key(param))
+    key = str(db._coerce_to_key(param))
   except db.BadArgumentError:
     raise KeyParameterError(param)
+  if isinstance(param,basestring):
+    _key_strings.set(param,key)
+  return key
+
+def _path_key_str(kind,id_or_name,parent=None):
+  '''Canonical key string of a key path, parent is a Key or None'''
+  path = (os.environ.get('APPLICATION_ID'),namespace_manager.get_namespace(),
+          kind,id_or_name,parent and str(parent))
+  key = _key_strings.get(path)
+  if key is None:
+    key = str(datastore.Key.from_path(kind,id_or_name,parent=parent))
+    _key_strings.set(path,key)
+    if not isinstance(id_or_name,basestring):
+      id_or_name = str(id_or_name)
+    _key_names.set(key,id_or_name)
+  return key
   
 def _id_or_name(_key_str):
-  key = db.Key(_key_str)
-  return key.name() or str(key.id())
+  result = _key_names.get(_key_str)
+  if result is None:
+    key = db.Key(_key_str)
+    result = key.name() or str(key.id())
+    _key_names.set(_key_str,result)
+  return result
+
+def _refresh_window(refresh_ahead):
+  '''Resolves a _refresh_ahead argument, None reads REFRESH_AHEAD and False
+  turns refresh-ahead off'''
+  if refresh_ahead is None:
+    refresh_ahead = REFRESH_AHEAD
+  if refresh_ahead is False:
+    return None
+  return refresh_ahead
 
 def _to_list(param): 
     if not isinstance(param,list):
@@ -90,37 +288,196 @@ def _to_dict(models):
     result[_key_str(model)] = model
   return result
 
+def _encode(model):
+  '''Converts a model to protobuf with a header byte, compressing it
+  if it is larger than the compression threshold of its kind'''
+  data = db.model_to_protobuf(model).Encode()
+  threshold,level = COMPRESSION_KINDS.get(model.kind(),
+                                          (COMPRESSION_THRESHOLD,COMPRESSION_LEVEL))
+  if threshold is not None and len(data) > threshold:
+    compressed = zlib.compress(data,level)
+    if len(compressed) < len(data):
+      return _ZLIB_HEADER+compressed
+  return _RAW_HEADER+data
+
+def _decode_entity(data):
+  '''Returns (entity,protobuf) of a value written by _encode, or a headerless 
+  protobuf, where protobuf is the uncompressed encoded entity'''
+  header = data[:1]
+  if header == _ZLIB_HEADER:
+    data = zlib.decompress(data[1:])
+  elif header == _RAW_HEADER:
+    data = data[1:]
+  return datastore.Entity.FromPb(entity_pb.EntityProto(data)),data
+
+def _from_entity(entity,data):
+  '''Converts an entity decoded from the protobuf data to a model'''
+  cls = db.class_for_kind(entity.kind())
+  if issubclass(cls,pdb.Model):
+    #The protobuf is at hand for the fingerprint
+    return cls.from_entity(entity,_data=data)
+  return cls.from_entity(entity)
+
+def _decode(data):
+  '''Converts a value written by _encode, or a headerless protobuf, to a model'''
+  return _from_entity(*_decode_entity(data))
+
+def _copy_entity(entity):
+  '''Copies an entity with its list values, a model keeps the entity it was
+  loaded from and writes its own values to it when it is put'''
+  copied = copy.copy(entity)
+  for name,value in copied.iteritems():
+    if isinstance(value,list):
+      dict.__setitem__(copied,name,list(value))
+  return copied
+
+def _expiry_time(expiration):
+  '''Timestamp a memcache expiration ends at, None if it never expires'''
+  if not expiration:
+    return None
+  elif expiration > 30*86400:
+    #Memcache takes expirations longer than 30 days as timestamps
+    return expiration
+  return time.time()+expiration
+
+def _wrap_expiry(data,expiration):
+  '''Prefixes a serialized model or a list of them with the timestamp
+  their memcache expiration ends at, so readers can refresh them ahead'''
+  expiry = _expiry_time(expiration)
+  if expiry is None or data is None:
+    return data
+  header = _EXPIRY_HEADER+_EXPIRY.pack(expiry)
+  if isinstance(data,str):
+    return header+data
+  return [header]+data
+
+def _unwrap_expiry(data):
+  '''Returns (data,expiration timestamp) of a value written by _wrap_expiry,
+  values without a timestamp are returned with None'''
+  size = _EXPIRY.size+1
+  if isinstance(data,str):
+    header = data[:size]
+    rest = data[size:]
+  elif isinstance(data,list) and len(data) and isinstance(data[0],str):
+    header = data[0]
+    rest = data[1:]
+  else:
+    return data,None
+  if len(header) != size or header[:1] != _EXPIRY_HEADER:
+    return data,None
+  return rest,_EXPIRY.unpack(header[1:])[0]
+
+'''Number of pdb.delete calls by kind in this instance, see SKIP_UNCHANGED'''
+_delete_epochs = {}
+
+def _fingerprint(model,data=None):
+  '''Digest of the datastore values of a model with the delete epoch of its
+  kind, data is the encoded protobuf of the model if it is at hand. 
+  Deletes only track the epochs of kinds that were fingerprinted'''
+  if data is None:
+    data = db.model_to_protobuf(model).Encode()
+  return (_delete_epochs.setdefault(model.kind(),0),hashlib.md5(data).digest())
+
+def _split_unchanged(models):
+  '''Returns (changed,unchanged,encoded) where encoded maps the ids of
+  changed models to their (fingerprint,size). Models without a fingerprint of
+  their last load or put count as changed'''
+  changed = []
+  unchanged = []
+  encoded = {}
+  for model in models:
+    data = db.model_to_protobuf(model).Encode()
+    fingerprint = _fingerprint(model,data)
+    if fingerprint == getattr(model,'_fingerprint',None):
+      unchanged.append(model)
+    else:
+      changed.append(model)
+      encoded[id(model)] = (fingerprint,len(data))
+  return changed,unchanged,encoded
+
 def _serialize(models):
   '''Improve memcache performance converting to protobuf'''
   if models is None:
     return None
   elif isinstance(models, db.Model):
     # Just one instance
-    return db.model_to_protobuf(models).Encode()
+    return _encode(models)
   else:
     # A list
-    return [db.model_to_protobuf(x).Encode() for x in models]
+    return [_encode(x) for x in models]
 
 def _deserialize(data):
   '''Improve memcache performance by converting from protobuf'''
   if data is None:
     return None
-  elif isinstance(data, str):
+  data = _unwrap_expiry(data)[0]
+  if isinstance(data, str):
     # Just one instance
-    return db.model_from_protobuf(entity_pb.EntityProto(data))
+    return _decode(data)
   else:
-    return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
+    return [_decode(x) for x in data]
+
+class _Encoded(str):
+  '''Marks a model that is stored in local cache in its serialized form'''
+  __slots__ = ()
+
+class _HotSet(object):
+  '''Least recently used set of entities decoded from LOCAL_ENCODED storage.
+  
+  Each entity is kept with the encoded value it was decoded from, so a new
+  value written to local cache for the same key is never answered with an
+  outdated model. Every caller gets a new model built from a copy of the 
+  entity, models are never shared between callers.
+  '''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.entities = OrderedDict()
+    
+  def decode(self,key,data):
+    decoded = None
+    with self.lock:
+      try:
+        decoded = self.entities.pop(key)
+        if decoded[0] is data:
+          self.entities[key] = decoded
+        else:
+          decoded = None
+      except KeyError:
+        pass
+    if decoded is None:
+      entity,protobuf = _decode_entity(str(data))
+      decoded = (data,entity,protobuf)
+      with self.lock:
+        self.entities[key] = decoded
+        while len(self.entities) > LOCAL_HOT_SET_SIZE:
+          self.entities.popitem(last=False)
+    return _from_entity(_copy_entity(decoded[1]),decoded[2])
+  
+  def discard(self,keys):
+    with self.lock:
+      for key in keys:
+        self.entities.pop(key,None)
+
+_hot_set = _HotSet()
+
+def _local_mode(model):
+  return LOCAL_KIND_MODES.get(model.kind(),LOCAL_MODE)
 
 def _cachepy_get(keys):
-  '''Get items with given keys from local cache'''
-  result = {}
-  for key in keys:
-    result[key] = cachepy.get(key)
+  '''Get items with given keys from local cache
+    Keys that aren't found are left out of the result
+  '''
+  result = cachepy.get_multi(keys)
+  for key,value in result.iteritems():
+    if isinstance(value,_Encoded):
+      result[key] = _hot_set.decode(key,value)
   return result
 
 def _cachepy_put(models,time = 0):
-  '''Put given models to local cache in serialized form
-   with expiration in seconds
+  '''Put given models to local cache with expiration in seconds
+  
+  Models are stored as they are or in serialized form, 
+  depending on the local storage mode of their kind.
   
   Args:
     models: List of models to be saved to local cache
@@ -133,75 +490,1366 @@ def _cachepy_put(models,time = 0):
   if time == 0: #cachepy uses None as unlimited caching flag
     time = None
   
-  for key, model in to_put.iteritems():
-    cachepy.set(key,model,time)
+  for key,model in to_put.iteritems():
+    if _local_mode(model) == LOCAL_ENCODED:
+      to_put[key] = _Encoded(_serialize(model))
+  _hot_set.discard(to_put)
+  cachepy.set_multi(to_put,time)
   return [model.key() for model in models]
 
 def _cachepy_delete(keys):
   '''Delete models with given keys from local cache'''
-  for key in keys: 
-      cachepy.delete(key)
+  cachepy.delete_multi(keys)
+  _hot_set.discard(keys)
 
-def _memcache_get(keys):
-  '''Get items with given keys from memcache
+def _snapshot_encode(value):
+  '''Converts a local cache value to a picklable (tag,value) pair'''
+  if isinstance(value,_Encoded):
+    return ('e',str(value))
+  elif isinstance(value,db.Model):
+    return ('m',_serialize(value))
+  elif isinstance(value,list) and len(value) and \
+      all(isinstance(model,db.Model) for model in value):
+    #Cached query results
+    return ('l',_serialize(value))
+  return ('v',value)
+
+def _snapshot_decode(data):
+  '''Restores a value converted by _snapshot_encode'''
+  tag,value = data
+  if tag == 'e':
+    return _Encoded(value)
+  elif tag in ('m','l'):
+    return _deserialize(value)
+  return value
+
+'''Local cache key classes for pdb.local_stats'''
+ENTITY_KEYS = 'entity'
+QUERY_KEYS = 'query'
+REFERENCE_INDEX_KEYS = 'reference_index'
+OTHER_KEYS = 'other'
+
+def _classify_key(key):
+  '''Local cache stats groups of a key: its class and its kind or query root'''
+  if not isinstance(key,basestring):
+    return ('class:'+OTHER_KEYS,)
+  if key.startswith(pdb.GqlQuery.key_prefix):
+    return ('class:'+QUERY_KEYS,'query:'+key.split(pdb.GqlQuery.delim,1)[0])
+  try:
+    kind = db.Key(key).kind()
+  except (db.BadKeyError,db.BadArgumentError):
+    return ('class:'+OTHER_KEYS,)
+  if kind == _ReferenceCacheIndex.kind():
+    return ('class:'+REFERENCE_INDEX_KEYS,'kind:'+kind)
+  return ('class:'+ENTITY_KEYS,'kind:'+kind)
+
+'''First item of the manifest that is stored in place of a chunked memcache value'''
+_CHUNK_MARKER = '__pdb_chunks__'
+
+def _chunk_key(key,version,index):
+  return '%s|chunk|%s|%d' % (key,version,index)
+
+def _is_manifest(value):
+  return isinstance(value,tuple) and len(value) == 5 and value[0] == _CHUNK_MARKER
+
+def _chunk(mapping):
+  '''Splits the values of a memcache key-value dictionary that are larger 
+  than MEMCACHE_CHUNK_SIZE.
+  
+  A chunked value is replaced with a manifest: (marker,version,chunk count,
+  checksum,pickled). Chunk keys contain a random version, so chunks of 
+  different writes of a key never mix.
+  '''
+  result = {}
+  for key,value in mapping.iteritems():
+    if isinstance(value,str):
+      data,pickled = value,False
+    elif isinstance(value,list) and \
+        sum(len(item) for item in value if isinstance(item,str)) < MEMCACHE_CHUNK_SIZE/2:
+      #Query results are lists of serialized models, most of them are small 
+      data = None
+    else:
+      data,pickled = pickle.dumps(value,pickle.HIGHEST_PROTOCOL),True
+    if data is None or len(data) <= MEMCACHE_CHUNK_SIZE:
+      result[key] = value
+      continue
+    version = os.urandom(4).encode('hex')
+    count = (len(data)+MEMCACHE_CHUNK_SIZE-1) // MEMCACHE_CHUNK_SIZE
+    for i in range(count):
+      result[_chunk_key(key,version,i)] = \
+        data[i*MEMCACHE_CHUNK_SIZE:(i+1)*MEMCACHE_CHUNK_SIZE]
+    result[key] = (_CHUNK_MARKER,version,count,zlib.crc32(data) & 0xffffffff,pickled)
+  return result
+
+def _unchunk(cache_results):
+  '''Replaces manifests in memcache results with the values they were made of.
+  All chunks are fetched with one get_multi. Values with missing chunks or a
+  checksum mismatch (torn writes, partial eviction) are removed from results.
+  '''
+  manifests = [(key,value) for key,value in cache_results.iteritems()
+               if _is_manifest(value)]
+  if not len(manifests):
+    return cache_results
+  chunk_keys = []
+  for key,(marker,version,count,checksum,pickled) in manifests:
+    chunk_keys.extend(_chunk_key(key,version,i) for i in range(count))
+  chunks = memcache.get_multi(chunk_keys)
+  for key,(marker,version,count,checksum,pickled) in manifests:
+    try:
+      data = ''.join(chunks[_chunk_key(key,version,i)] for i in range(count))
+    except KeyError:
+      data = None
+    if data is None or zlib.crc32(data) & 0xffffffff != checksum:
+      logging.info('PerformanceEngine incomplete memcache chunks for %s' % key)
+      del cache_results[key]
+    elif pickled:
+      cache_results[key] = pickle.loads(data)
+    else:
+      cache_results[key] = data
+  return cache_results
+
+def _memcache_get_value(key):
+  '''Gets a possibly chunked value from memcache'''
+  return _unchunk(memcache.get_multi([key])).get(key)
+
+def _memcache_set_value(key,value,time = 0):
+  '''Sets a value in memcache, chunking it if it is too large'''
+  return memcache.set_multi(_chunk({key:value}),time)
+
+def _memcache_get_async(keys):
+  '''Starts a memcache lookup for given keys, see _memcache_results'''
+  return memcache.Client().get_multi_async(keys)
+
+def _memcache_results(keys,cache_results,expiries=None):
+  '''Deserializes memcache results for given keys
     If no model is found for given key, value for that key
-    in result is set to None
+    in result is set to None. Expiration timestamps of the values 
+    are added to expiries if it is given.
   '''
-  cache_results = memcache.get_multi(keys)
+  cache_results = _unchunk(cache_results)
   result = {}
   for key in keys:
     try:
-      result[key] = _deserialize(cache_results[key])
+      value = cache_results[key]
     except KeyError:
       result[key] = None
+      continue
+    if value == _TOMBSTONE:
+      result[key] = _TOMBSTONE
+      continue
+    value,expiry = _unwrap_expiry(value)
+    if expiries is not None and expiry is not None:
+      expiries[key] = expiry
+    result[key] = _deserialize(value)
   return result
-    
-def _memcache_put(models,time = 0):
-  '''Put given models to memcache in serialized form
+
+def _memcache_get(keys):
+  '''Get items with given keys from memcache
+    If no model is found for given key, value for that key
+    in result is set to None, tombstones are returned as they are
+  '''
+  return _memcache_results(keys,_memcache_get_async(keys).get_result())
+
+def _memcache_put_async(models,time = 0):
+  '''Starts a memcache write of given models in serialized form
    with expiration in seconds
      
   Returns:
-    List of  db.Keys of the models that were put
+    A memcache RPC
   '''         
   to_put = _to_dict(models)
         
   for key,model in to_put.iteritems():
-      to_put[key] = _serialize(model)
+      to_put[key] = _wrap_expiry(_serialize(model),time)
           
-  memcache.set_multi(to_put,time)
+  return memcache.Client().set_multi_async(_chunk(to_put),time)
+    
+def _memcache_put(models,time = 0):
+  '''Put given models to memcache in serialized form
+   with expiration in seconds
+     
+  Returns:
+    List of  db.Keys of the models that were put
+  '''         
+  _memcache_put_async(models,time).get_result()
   return [model.key() for model in models]
 
+def _memcache_delete_async(keys):
+  '''Starts a memcache delete of models with given keys'''
+  return memcache.Client().delete_multi_async(keys)
+
 def _memcache_delete(keys):
   '''Delete models with given keys from memcache'''
-  memcache.delete_multi(keys)
+  _memcache_delete_async(keys).get_result()
+
+def _lease_key(key):
+  return key+'|lease'
+
+def _acquire_leases(keys):
+  '''Tries to add lease entries for given memcache keys
+  
+  Returns:
+    (granted,contended) lists of keys, contended keys have leases held 
+    by other requests. If memcache fails every lease is granted.
+  '''
+  if not LEASES:
+    return keys,[]
+  mapping = dict((_lease_key(key),os.getpid()) for key in keys)
+  status = memcache.Client().add_multi_async(mapping,LEASE_EXPIRATION).get_result()
+  if status is None:
+    return keys,[]
+  granted = []
+  contended = []
+  for key in keys:
+    if status.get(_lease_key(key)) == memcache.NOT_STORED:
+      contended.append(key)
+    else:
+      granted.append(key)
+  _count('leases_granted',len(granted))
+  return granted,contended
+
+def _release_leases(keys):
+  '''Deletes leases after the refill of their keys is sent to memcache'''
+  if len(keys):
+    _fire_and_forget(memcache.Client().delete_multi_async(map(_lease_key,keys)))
+
+def _wait_leases(keys):
+  '''Polls memcache for keys that lease holders are refilling
+  
+  Returns:
+    A key-value dictionary of raw memcache values that arrived in time
+  '''
+  result = {}
+  deadline = time.time()+LEASE_WAIT
+  while len(keys) and time.time() < deadline:
+    time.sleep(LEASE_POLL_INTERVAL)
+    found = _unchunk(memcache.get_multi(keys))
+    result.update(found)
+    keys = [key for key in keys if key not in found]
+  _count('leases_waited',len(result))
+  _count('lease_timeouts',len(keys))
+  return result
+
+class _PendingRPCs(threading.local):
+  '''Cache refill RPCs started by this thread that nobody waits for and 
+  local cache refreshes that wait for the end of the request'''
+  def __init__(self):
+    self.rpcs = []
+    self.refreshes = OrderedDict()
+
+_pending = _PendingRPCs()
+
+def _fire_and_forget(rpc):
+  '''Keeps an RPC until the next pdb call of the same thread or pdb.wait_all'''
+  _pending.rpcs.append(rpc)
   
+def _wait_pending():
+  '''Completes fire and forget RPCs, so a thread always reads its own cache refills.
+  Sends counter increments buffered for longer than COUNTER_BUFFER_TIME too'''
+  _flush_stale_counters()
+  rpcs = _pending.rpcs
+  if not rpcs:
+    return
+  _pending.rpcs = []
+  for rpc in rpcs:
+    try:
+      rpc.get_result()
+    except Exception, e:
+      logging.warning('PerformanceEngine cache refill failed: %s' % e)
+
+def _refresh_later(key,function,args):
+  '''Queues a local cache refresh until pdb.wait_all, keys queued with the same
+  function and arguments are refreshed with one function(keys,*args) call.
+  Keys over REFRESH_QUEUE_SIZE are dropped, when nothing calls pdb.wait_all'''
+  refreshes = _pending.refreshes
+  if key in refreshes or len(refreshes) >= REFRESH_QUEUE_SIZE:
+    return
+  refreshes[key] = (function,args)
+
+def _run_refreshes():
+  refreshes = _pending.refreshes
+  if not refreshes:
+    return
+  _pending.refreshes = OrderedDict()
+  batches = []
+  for key,(function,args) in refreshes.iteritems():
+    for batch in batches:
+      if batch[0] is function and batch[1] == args:
+        batch[2].append(key)
+        break
+    else:
+      batches.append((function,args,[key]))
+  for function,args,keys in batches:
+    try:
+      function(keys,*args)
+    except Exception, e:
+      logging.warning('PerformanceEngine local cache refresh failed: %s' % e)
+
+def _refresh_in_background(keys,function,*args):
+  '''Defers function(keys,*args) to refresh memcache entries, keys are leased
+  so only one request queues a refresh for them'''
+  granted,contended = _acquire_leases(keys)
+  if not len(granted):
+    return
+  try:
+    deferred.defer(function,granted,*args)
+    _count('memcache_refreshes',len(granted))
+  except Exception, e:
+    logging.warning('PerformanceEngine memcache refresh failed: %s' % e)
+    _release_leases(granted)
+
+def _refresh_local(keys,storage,local_expiration,memcache_expiration):
+  '''Rewrites local cache entries from the storage layers below it'''
+  models = pdb.get(keys,_storage=list(storage),
+                   _memcache_expiration=memcache_expiration,
+                   _result_type=DICT,
+                   _refresh_ahead=False)
+  found = [model for model in models.itervalues() if model is not None]
+  if len(found):
+    _cachepy_put(found,local_expiration)
+  _count('local_refreshes',len(found))
+
+def _refresh_memcache(keys,memcache_expiration):
+  '''Deferred task that rewrites memcache entries from datastore before they expire'''
+  models = dict(zip(keys,db.get(keys)))
+  found = [model for model in models.itervalues() if model is not None]
+  if len(found):
+    _memcache_put(found,memcache_expiration)
+  missing = [key for key,model in models.iteritems() if model is None]
+  if len(missing):
+    _memcache_delete(missing)
+  memcache.delete_multi(map(_lease_key,keys))
+
+def _refresh_local_query(keys,query_string,args,kwds,limit,offset,
+                         memcache_flag,local_expiration,memcache_expiration):
+  '''Rewrites a local cache query result from memcache or datastore'''
+  query = pdb.GqlQuery(query_string,*args,**dict(kwds))
+  result = query.fetch(limit,offset,
+                       _cache=MEMCACHE if memcache_flag else None,
+                       _memcache_expiration=memcache_expiration,
+                       _refresh_ahead=False)
+  cachepy.set(keys[0],result,local_expiration)
+  _count('local_refreshes')
+
+def _refresh_query(keys,query_string,args,kwds,limit,offset,memcache_expiration):
+  '''Deferred task that reruns a query before its memcache result expires'''
+  query = pdb.GqlQuery(query_string,*args,**dict(kwds))
+  result = query.query.fetch(limit,offset)
+  _memcache_set_value(keys[0],_wrap_expiry(_serialize(result),memcache_expiration),
+                      memcache_expiration)
+  memcache.delete_multi(map(_lease_key,keys))
+
+'''Datastore writes are split in batches of PUT_BATCH_MIN to PUT_BATCH_MAX models
+and at most PUT_BATCH_BYTES encoded bytes. Batch sizes follow the observed write 
+latency so a batch takes about PUT_BATCH_LATENCY seconds, PUT_BATCH_SIZE is used 
+until there is a measurement. At most PUT_MAX_IN_FLIGHT batches are written at once'''
+PUT_BATCH_SIZE = 50
+PUT_BATCH_MIN = 10
+PUT_BATCH_MAX = 500
+PUT_BATCH_BYTES = 1000000 - 100000
+PUT_BATCH_LATENCY = 0.5
+PUT_MAX_IN_FLIGHT = 8
+
+class _WriteLatency(object):
+  '''Exponentially weighted moving average of datastore write time per model'''
+  def __init__(self,weight=0.3):
+    self.lock = threading.Lock()
+    self.weight = weight
+    self.per_model = None
+    
+  def observe(self,seconds,count):
+    sample = seconds/max(count,1)
+    with self.lock:
+      if self.per_model is None:
+        self.per_model = sample
+      else:
+        self.per_model += self.weight*(sample-self.per_model)
+  
+  def batch_size(self):
+    per_model = self.per_model
+    if not per_model:
+      return PUT_BATCH_SIZE
+    return max(PUT_BATCH_MIN,min(PUT_BATCH_MAX,int(PUT_BATCH_LATENCY/per_model)))
+
+_write_latency = _WriteLatency()
+
+class _PutRPC(object):
+  '''Datastore write of a list of models in adaptive batches, several of them in flight.
+  
+  Batches are formed as earlier ones complete, so their sizes follow the latency 
+  measured by the same call. get_result() returns the keys of the models that 
+  were written in model order. Only the batches that fail with 
+  DeadlineExceededError, and the models that were never sent after a 
+  CapabilityDisabledError, are spilled for retry, see _spill. attempt is the
+  number of times the models failed before.
+  '''
+  def __init__(self,models,attempt=0,sizes=None):
+    self.models = models
+    self.attempt = attempt
+    self.sizes = sizes or {}
+    self.keys = None
+    self.position = 0
+    self.in_flight = []
+    self.results = []
+    self.timed_out = []
+    self.disabled = []
+    self.waited = None
+    self._dispatch()
+  
+  def _next_batch(self):
+    size = _write_latency.batch_size()
+    start = self.position
+    end = start
+    total = 0
+    while end < len(self.models) and end-start < size:
+      model = self.models[end]
+      model_size = self.sizes.get(id(model))
+      if model_size is None:
+        model_size = db.model_to_protobuf(model).ByteSize()
+      total += model_size
+      if total > PUT_BATCH_BYTES and end > start:
+        break
+      end += 1
+    self.position = end
+    return self.models[start:end]
+  
+  def _dispatch(self):
+    while len(self.in_flight) < PUT_MAX_IN_FLIGHT and self.position < len(self.models):
+      batch = self._next_batch()
+      self.in_flight.append((len(self.results),batch,db.put_async(batch),time.time()))
+      self.results.append([])
+  
+  def get_result(self):
+    if self.keys is not None:
+      return self.keys
+    while len(self.in_flight):
+      index,batch,rpc,start = self.in_flight.pop(0)
+      #Latency is the time spent waiting for this batch, batches in flight
+      #behind it are partly written while it is waited for
+      start = max(start,self.waited)
+      try:
+        self.results[index] = rpc.get_result()
+        _write_latency.observe(time.time()-start,len(batch))
+      except apiproxy_errors.DeadlineExceededError:
+        #Counted as twice the latency budget, so the next batches are smaller
+        _write_latency.observe(max(time.time()-start,PUT_BATCH_LATENCY*2),len(batch))
+        self.timed_out.extend(batch)
+      except apiproxy_errors.CapabilityDisabledError:
+        self.disabled.extend(batch)
+        self.disabled.extend(self.models[self.position:])
+        self.position = len(self.models)
+      self.waited = time.time()
+      self._dispatch()
+      
+    if len(self.timed_out):
+      _spill(self.timed_out,self.attempt)
+    if len(self.disabled):
+      #Datastore is read only, retry chunks travel in the tasks
+      _spill(self.disabled,self.attempt,None)
+    self.keys = []
+    for keys in self.results:
+      self.keys.extend(keys)
+    return self.keys
+
 def _put(models,countdown=0):
-  batch_size = 50
-  to_put = []
+  #countdown is kept for tasks deferred before retry chunks
+  return _PutRPC(models).get_result()
+
+'''Models that fail to be written are spilled in encoded chunks of at most
+RETRY_CHUNK_BYTES bytes to _RetryChunk entities, retry tasks carry chunk 
+references only. When datastore is read only chunks of at most RETRY_TASK_BYTES
+travel in the task payload, only a model too big for a task is kept in memcache,
+where an eviction loses it. Retries back off exponentially from RETRY_COUNTDOWN
+to RETRY_MAX_COUNTDOWN seconds with jitter. Models are given up after 
+RETRY_MAX_ATTEMPTS failed attempts'''
+RETRY_CHUNK_BYTES = 1000000 - 100000
+RETRY_TASK_BYTES = 100000 - 10000
+RETRY_COUNTDOWN = 10
+RETRY_MAX_COUNTDOWN = 3600
+RETRY_MAX_ATTEMPTS = 20
+RETRY_EXPIRATION = 7*86400
+
+def _retry_key(key):
+  '''Memcache marker of the retry chunk that holds the pending write of a key'''
+  return key+'|retry'
+
+def _supersede_retries_async(keys):
+  '''Marks the pending retries of keys as superseded by a newer write,
+  only keys that have a retry marker are touched'''
+  return memcache.Client().replace_multi_async(
+    dict((_retry_key(key),'') for key in keys),RETRY_EXPIRATION)
+
+def _retry_chunk_key(chunk_id):
+  return 'pdb_retry|'+chunk_id
+
+def _backoff(attempt):
+  countdown = min(RETRY_MAX_COUNTDOWN,RETRY_COUNTDOWN*2**attempt)
+  return random.uniform(countdown/2.0,countdown)
+
+def _store_chunk(chunk_id,data,storage):
+  '''Stores encoded models of a retry chunk, storage is DATASTORE or None 
+  when datastore is read only
+  
+  Returns:
+    Storage layer the chunk is in, None if it travels in the task
+  '''
+  if storage == DATASTORE:
+    try:
+      _RetryChunk(key_name=chunk_id,models=map(db.Blob,data)).put()
+      return DATASTORE
+    except (db.Timeout,apiproxy_errors.DeadlineExceededError,
+            apiproxy_errors.CapabilityDisabledError):
+      pass
+  if sum(map(len,data)) <= RETRY_TASK_BYTES:
+    return None
+  if not len(memcache.set_multi(_chunk({_retry_chunk_key(chunk_id):data}),
+                                RETRY_EXPIRATION)):
+    logging.warning('PerformanceEngine retry chunk %s is too big for a task and is '
+                    'kept in memcache only, it is not durable' % chunk_id)
+    return MEMCACHE
+  return None
+
+def _spill(models,attempt,storage=DATASTORE):
+  '''Stores models that couldn't be written in retry chunks and queues
+  a retry task for each chunk, storage is None when datastore is read only.
+  Writes of the same keys spilled later or written by pdb.put meanwhile 
+  supersede them.'''
+  if attempt >= RETRY_MAX_ATTEMPTS:
+    logging.error('PerformanceEngine gave up writing %d models after %d attempts' % 
+                  (len(models),attempt))
+    return
+  limit = RETRY_CHUNK_BYTES if storage == DATASTORE else RETRY_TASK_BYTES
+  chunks = [[]]
+  size = 0
+  for model in models:
+    data = _encode(model)
+    if len(chunks[-1]) and size+len(data) > limit:
+      chunks.append([])
+      size = 0
+    key = str(model.key()) if model.has_key() else None
+    chunks[-1].append((key,data))
+    size += len(data)
+  for chunk in chunks:
+    chunk_id = os.urandom(8).encode('hex')
+    data = [value for key,value in chunk]
+    stored = _store_chunk(chunk_id,data,storage)
+    memcache.set_multi(dict((_retry_key(key),chunk_id) for key,value in chunk 
+                            if key is not None),RETRY_EXPIRATION)
+    deferred.defer(_retry_chunk,stored,chunk_id,attempt,
+                   None if stored else data,
+                   _countdown=int(_backoff(attempt)))
+  _count('retry_spilled',len(models))
+
+def _retry_chunk(storage,chunk_id,attempt,data=None):
+  '''Deferred task that writes the pending models of a retry chunk'''
+  if storage == DATASTORE:
+    chunk = _RetryChunk.get_by_key_name(chunk_id)
+    if chunk is not None:
+      data = chunk.models
+  elif storage == MEMCACHE:
+    data = _memcache_get_value(_retry_chunk_key(chunk_id))
+  if data is None:
+    logging.error('PerformanceEngine retry chunk %s is lost' % chunk_id)
+    return
+  models = [_decode(str(value)) for value in data]
+  keys = [str(model.key()) if model.has_key() else None for model in models]
+  client = memcache.Client()
+  markers = client.get_multi([_retry_key(key) for key in keys if key is not None],
+                             for_cas=True)
+  #Missing markers were evicted, the chunk is written as if it is the latest
+  pending = [model for key,model in zip(keys,models) if key is None or
+             markers.get(_retry_key(key),chunk_id) == chunk_id]
+  _count('retry_superseded',len(models)-len(pending))
+  _count('retry_written',len(_PutRPC(pending,attempt+1).get_result()))
+  if storage == DATASTORE:
+    db.delete(db.Key.from_path(_RetryChunk.kind(),chunk_id))
+  elif storage == MEMCACHE:
+    memcache.delete(_retry_chunk_key(chunk_id))
+  #Markers a new spill of the same keys rewrote meanwhile fail the cas
+  client.cas_multi(dict((marker,'') for marker,value in markers.iteritems() 
+                        if value == chunk_id),1)
+
+def _journal_key(window,slot):
+  return 'pdb_write_behind|%d|%s' % (window,slot)
+
+def _dirty_key(key):
+  return key+'|dirty'
+
+_scheduled_lock = threading.Lock()
+_scheduled_windows = set()
+
+def _schedule_flush(window):
+  '''Adds the named flush task of a window once per instance'''
+  with _scheduled_lock:
+    if window in _scheduled_windows:
+      return
+    _scheduled_windows.add(window)
+    for scheduled in list(_scheduled_windows):
+      if scheduled < window-1:
+        _scheduled_windows.discard(scheduled)
+  countdown = (window+1)*WRITE_BEHIND_WINDOW-time.time()+WRITE_BEHIND_GRACE
+  try:
+    deferred.defer(_flush_window,window,_countdown=max(int(countdown),1),
+                   _name='pdb-write-behind-%d' % window)
+  except (taskqueue.TaskAlreadyExistsError,taskqueue.TombstonedTaskError):
+    pass
+
+def _write_behind(models):
+  '''Stores the latest versions of models in memcache and journals their keys
+  in the current window
+  
+  Returns:
+    False if memcache fails or the window was flushed before the keys were 
+    journaled, so the models should be written to datastore
+  '''
+  client = memcache.Client()
+  keys = map(_key_str,models)
+  dirty = dict((_dirty_key(key),_serialize(model)) for key,model in zip(keys,models))
+  if len(client.set_multi(_chunk(dirty),WRITE_BEHIND_EXPIRATION)):
+    return False
+  window = int(time.time())//WRITE_BEHIND_WINDOW
+  slot = client.incr(_journal_key(window,'count'),initial_value=0)
+  if slot is None or \
+      not client.set(_journal_key(window,slot),keys,WRITE_BEHIND_EXPIRATION):
+    return False
+  #The flush takes the marker before it reads the journal, a journal entry 
+  #written before the marker is taken is always flushed
+  if client.get(_journal_key(window,'flushed')) is not None:
+    return False
+  _count('write_behind_puts',len(keys))
+  _schedule_flush(window)
+  return True
+
+def _flush_window(window):
+  '''Writes the latest versions of the models journaled in a window to datastore
+  
+  Returns:
+    Number of models written
+  '''
+  client = memcache.Client()
+  if not client.add(_journal_key(window,'flushed'),1,WRITE_BEHIND_EXPIRATION):
+    return 0
+  count = client.get(_journal_key(window,'count'))
+  if not count:
+    return 0
+  slots = client.get_multi([_journal_key(window,slot) for slot in range(1,count+1)])
+  if len(slots) < count:
+    logging.warning('PerformanceEngine write behind journal of window %d is incomplete' % window)
   keys = []
+  for slot in range(1,count+1):
+    keys.extend(slots.get(_journal_key(window,slot),[]))
+  dirty_keys = list(OrderedDict.fromkeys(map(_dirty_key,keys)))
+  dirty = client.get_multi(dirty_keys,for_cas=True)
+  models = [_deserialize(value) for value in _unchunk(dict(dirty)).itervalues() if value]
+  if len(models):
+    try:
+      _put(models)
+    except Exception:
+      #The marker is the flush lock, a failed flush is left to the task retry
+      client.delete(_journal_key(window,'flushed'))
+      raise
+  #Versions written again after they were read stay for the next window
+  client.cas_multi(dict((key,'') for key in dirty),WRITE_BEHIND_WINDOW)
+  _count('write_behind_writes',len(models))
+  return len(models)
+
+'''Counter values are kept in memcache with this offset, so deltas and sums can
+be negative although memcache counters are unsigned'''
+_COUNTER_BIAS = 2**62
+
+def _counter_key(name,slot):
+  return 'pdb_counter|%s|%s' % (slot,name)
+
+def _shard_keys(name,shards):
+  return [db.Key.from_path(_CounterShard.kind(),'%s|%d' % (name,index)) 
+          for index in range(shards)]
+
+_counter_lock = threading.Lock()
+_counter_buffer = {}
+_counter_flushed = [time.time()]
+_scheduled_folds = set()
+
+def _buffer_count(name,shards,delta):
+  '''Pre-aggregates increments of the instance before they are sent to memcache'''
+  with _counter_lock:
+    _counter_buffer.setdefault(name,[shards,0])[1] += delta
+    if time.time()-_counter_flushed[0] < COUNTER_BUFFER_TIME:
+      return
+  _flush_counters()
+
+def _flush_stale_counters():
+  '''Sends the buffered increments if they are older than COUNTER_BUFFER_TIME,
+  so they don't wait for the next increment after a quiet period'''
+  if len(_counter_buffer) and time.time()-_counter_flushed[0] >= COUNTER_BUFFER_TIME:
+    _flush_counters()
+
+def _buffered_count(name):
+  with _counter_lock:
+    return _counter_buffer.get(name,[0,0])[1]
+
+def _flush_counters():
+  '''Adds the buffered increments to memcache in one call and schedules 
+  their folds'''
+  with _counter_lock:
+    buffered = dict(_counter_buffer)
+    _counter_buffer.clear()
+    _counter_flushed[0] = time.time()
+  if not len(buffered):
+    return
+  results = memcache.offset_multi(dict((_counter_key(name,'delta'),delta) 
+                                       for name,(shards,delta) in buffered.iteritems()),
+                                  initial_value=_COUNTER_BIAS)
+  for name,(shards,delta) in buffered.iteritems():
+    if results.get(_counter_key(name,'delta')) is None:
+      logging.warning('PerformanceEngine lost %d increments of counter %s' % (delta,name))
+    else:
+      _schedule_fold(name,shards)
+
+def _schedule_fold(name,shards):
+  '''Adds the named fold task of a counter once per fold interval and instance'''
+  window = int(time.time())//COUNTER_FOLD_INTERVAL
+  with _counter_lock:
+    if (name,window) in _scheduled_folds:
+      return
+    for scheduled in list(_scheduled_folds):
+      if scheduled[1] < window:
+        _scheduled_folds.discard(scheduled)
+    _scheduled_folds.add((name,window))
+  countdown = (window+1)*COUNTER_FOLD_INTERVAL-time.time()+1
+  try:
+    deferred.defer(_fold_counter,name,shards,_countdown=max(int(countdown),1),
+                   _name='pdb-counter-%s-%d' % (hashlib.md5(name).hexdigest(),window))
+  except (taskqueue.TaskAlreadyExistsError,taskqueue.TombstonedTaskError):
+    pass
+
+def _add_to_shard(key,delta):
+  shard = db.get(key)
+  if shard is None:
+    shard = _CounterShard(key=key)
+  shard.count += delta
+  db.put(shard)
+
+def _fold_counter(name,shards):
+  '''Deferred task that moves the memcache delta of a counter into a 
+  random datastore shard'''
+  client = memcache.Client()
+  delta_key = _counter_key(name,'delta')
+  while True:
+    value = client.gets(delta_key)
+    if value is None or int(value) == _COUNTER_BIAS:
+      return
+    if client.cas(delta_key,_COUNTER_BIAS):
+      break
+  delta = int(value)-_COUNTER_BIAS
+  try:
+    db.run_in_transaction(_add_to_shard,random.choice(_shard_keys(name,shards)),delta)
+  except Exception:
+    client.offset_multi({delta_key:delta},initial_value=_COUNTER_BIAS)
+    raise
+  client.offset_multi({_counter_key(name,'sum'):delta})
+  _count('counter_folds')
+
+def _windows(iterable,size):
+  '''Splits an iterable into lists of size items'''
+  iterator = iter(iterable)
+  while True:
+    window = list(itertools.islice(iterator,size))
+    if not len(window):
+      return
+    yield window
+
+def _reference_property(model,reference_name):
+  '''Returns the db.ReferenceProperty of a model by name'''
   try:
-    last_index = 0
-    for i,model in enumerate(models):
-      to_put.append(model)
-      last_index = i
-      if (i+1) % batch_size == 0:
-        keys.extend(db.put(to_put))
-        to_put = []
-    keys.extend(db.put(to_put))
+    property = model.properties()[reference_name]
+  except KeyError:
+    raise ReferenceError(reference_name, ReferenceError.REFERENCE_NAME_ERROR)
+  if not isinstance(property, db.ReferenceProperty):
+    raise ReferenceError(property.__class__.__name__,ReferenceError.TYPE_ERROR)
+  return property
+
+def _resolved_attr(property):
+  '''Attribute db.ReferenceProperty keeps the resolved model in'''
+  return '_RESOLVED'+property._attr_name()
+
+def _normalize_keys(keys):
+  if len(keys) > 1:
     return keys
+  elif len(keys):
+    return keys[0]
+  else:
+    return None
+
+def _format_result(keys,models,result_type):
+  '''Converts a key-model dictionary to the result type of pdb.get'''
+  if result_type == LIST:
+    #Restore the order of entities
+    result = []
+    for key in keys:
+      try:
+        result.append(models[key])
+      except KeyError:
+        result.append(None)
+    #Normalized result
+    if len(result) > 1 or len(result) == 0:
+      return result
+    else:
+      return result[0]
+  elif result_type == DICT:
+    return models
+  elif result_type == NAME_DICT:
+    result = {}
+    for k,v in models.iteritems():
+      result[_id_or_name(k)] = v
+    return result
+  else:
+    raise ResultTypeError(result_type)
+
+class GetLayer(object):
+  '''Storage layer pdb.get reads, see GET_LAYERS.
+  
+  Subclasses must implement get_async. Layers that answer right away are 
+  synchronous, pdb.get reads them before the next layer is started. The other
+  methods are optional hooks of the pipeline, get is the _AsyncGet calling 
+  them.
+  '''
+  __metaclass__ = abc.ABCMeta
+  synchronous = False
+  
+  @abc.abstractmethod
+  def get_async(self,keys,get):
+    '''Starts a lookup of keys, a list of key strings.
+    
+    Returns:
+      An object whose get_result() returns a dictionary of the keys the layer
+      has, values are models or _TOMBSTONE. Missing keys are left out.
+    '''
+  
+  def refresh(self,get,rpc,results):
+    '''Refreshes results that are about to expire, see REFRESH_AHEAD'''
     
-  except apiproxy_errors.DeadlineExceededError:
-    keys.extend(db.put(to_put))
-    deferred.defer(_put,models[last_index+1:],_countdown=10)
+  def lease(self,get,keys):
+    '''Returns the keys the layer missed that the next layers should read'''
     return keys
   
-  except apiproxy_errors.CapabilityDisabledError:
-    if not countdown:
-      countdown = 30
+  def put_tombstones(self,get,keys):
+    '''Remembers that datastore doesn't have given keys'''
+    
+  def fill(self,get,models):
+    '''Stores the models it missed that were found in the next layers'''
+
+class _LocalLayer(GetLayer):
+  synchronous = True
+  
+  def get_async(self,keys,get):
+    return _Done(_cachepy_get(keys))
+  
+  def refresh(self,get,rpc,results):
+    storage = tuple(layer for layer in get.storage if layer != LOCAL)
+    if not len(storage):
+      return
+    found = [key for key,value in results.iteritems() if value != _TOMBSTONE]
+    for key in get._soft_expired(cachepy.expiries(found)):
+      _refresh_later(key,_refresh_local,
+                     (storage,get.local_expiration,get.memcache_expiration))
+  
+  def put_tombstones(self,get,keys):
+    #cachepy uses None as unlimited caching flag
+    cachepy.set_multi(dict.fromkeys(keys,_TOMBSTONE),get.tombstone_expiration or None)
+    
+  def fill(self,get,models):
+    if len(models):
+      _cachepy_put(models,get.local_expiration)
+
+class _MemcacheLookup(object):
+  def __init__(self,keys):
+    self.keys = keys
+    self.rpc = _memcache_get_async(keys)
+    self.expiries = {}
+    
+  def get_result(self):
+    results = _memcache_results(self.keys,self.rpc.get_result(),self.expiries)
+    return dict((key,value) for key,value in results.iteritems() if value is not None)
+
+class _MemcacheLayer(GetLayer):
+  
+  def get_async(self,keys,get):
+    return _MemcacheLookup(keys)
+  
+  def refresh(self,get,rpc,results):
+    if DATASTORE not in get.storage:
+      return
+    keys = get._soft_expired(rpc.expiries)
+    if len(keys):
+      _refresh_in_background(keys,_refresh_memcache,get.memcache_expiration)
+  
+  def lease(self,get,keys):
+    '''Takes leases of memcache misses and waits for the refills of contended 
+    keys, see _acquire_leases'''
+    if DATASTORE not in get.storage:
+      return keys
+    get.leases,contended = _acquire_leases(keys)
+    if not len(contended):
+      return keys
+    found = _wait_leases(contended)
+    results = _memcache_results(found.keys(),found)
+    missed = get._resolve(MEMCACHE,contended,
+                          dict((key,value) for key,value in results.iteritems() 
+                               if value is not None))
+    #Lease holders refill memcache for contended keys
+    get.missed[MEMCACHE] = get.leases
+    return get.leases+missed
+  
+  def put_tombstones(self,get,keys):
+    _fire_and_forget(memcache.Client().set_multi_async(
+      dict.fromkeys(keys,_TOMBSTONE),get.tombstone_expiration))
+  
+  def fill(self,get,models):
+    if len(models):
+      _fire_and_forget(_memcache_put_async(models,get.memcache_expiration))
+    _release_leases(get.leases)
+
+class _DatastoreLookup(object):
+  def __init__(self,keys):
+    self.keys = keys
+    self.rpc = db.get_async(keys)
+    
+  def get_result(self):
+    #Datastore results are in key order, so keys aren't coerced again
+    return dict((key,model) for key,model in zip(self.keys,self.rpc.get_result())
+                if model is not None)
+
+class _DatastoreLayer(GetLayer):
+  
+  def get_async(self,keys,get):
+    return _DatastoreLookup(keys)
+
+'''Storage layers pdb.get reads in this order, name: GetLayer. Layers can be
+replaced, and layers added under new names can be read with pdb.get and are
+filled by it, pdb.put and pdb.delete only know the built-in layers'''
+GET_LAYERS = OrderedDict([(LOCAL,_LocalLayer()),
+                          (MEMCACHE,_MemcacheLayer()),
+                          (DATASTORE,_DatastoreLayer())])
+
+class _AsyncGet(object):
+  '''pdb.get pipeline built on asynchronous memcache and datastore calls.
+  
+  Keys are read from the layers of GET_LAYERS in order, each layer only gets
+  the keys the layers above it missed and its results are taken in one pass.
+  Synchronous layers like local cache are read and the first asynchronous
+  lookup is started as soon as the pipeline is created. get_result() takes
+  the remaining layers in turn and refills the layers that missed keys found
+  below them. Memcache refills are fire and forget. sources maps every key 
+  found to the layer that answered it.
+  
+  Keys that datastore doesn't have get tombstones in cache layers, 
+  a tombstone answers None without reading the layers below it.
+  
+  Only the request holding the lease of a memcache miss reads it from 
+  datastore and refills memcache, see _acquire_leases.
+  
+  Entries within refresh_ahead seconds of their expiration are refreshed
+  in the background, see REFRESH_AHEAD.
+  
+  Inside pdb.request_scope models found once are returned again without
+  reading any storage layer.
+  '''
+  def __init__(self,keys,storage,local_expiration,memcache_expiration,result_type,
+               tombstone_expiration=None,refresh_ahead=None):
+    if result_type not in (LIST,DICT,NAME_DICT):
+      raise ResultTypeError(result_type)
+    _wait_pending()
+    self.keys = map(_key_str,_to_list(keys))
+    self.storage = storage
+    self.local_expiration = local_expiration
+    self.memcache_expiration = memcache_expiration
+    self.result_type = result_type
+    self.tombstone_expiration = tombstone_expiration
+    self.refresh_ahead = refresh_ahead
+    self.layers = [(name,layer) for name,layer in GET_LAYERS.iteritems() 
+                   if name in storage]
+    self.index = 0
+    self.models = {}
+    self.sources = {}
+    self.missed = {}
+    self.tombstones = []
+    self.leases = []
+    self.rpc = None
+    self.done = False
+    
+    keys = list(OrderedDict.fromkeys(self.keys))
+    #Writes buffered by pdb.batch, then models of the request scope, answer 
+    #before any storage layer
+    buffered = _batch_lookup(keys,storage)
+    if len(buffered):
+      keys = self._resolve('batch',keys,buffered)
+    if _scope.depth:
+      scoped = _scope_lookup(keys)
+      if len(scoped):
+        _count('scope_hits',len(scoped))
+        keys = self._resolve('scope',keys,scoped)
+    self._read(keys)
+    
+  def _resolve(self,source,keys,results):
+    '''Takes the results of a layer for given keys in one pass
+    
+    Returns:
+      Keys that aren't in results
+    '''
+    missed = []
+    models = self.models
+    sources = self.sources
+    tombstones = 0
+    for key in keys:
+      try:
+        value = results[key]
+      except KeyError:
+        missed.append(key)
+        continue
+      if value == _TOMBSTONE:
+        self.tombstones.append(key)
+        tombstones += 1
+        value = None
+      models[key] = value
+      sources[key] = source
+    if tombstones:
+      _count(source+'_tombstone_hits',tombstones)
+    return missed
+  
+  def _read(self,keys):
+    '''Reads keys from the next layers until an asynchronous lookup is started'''
+    while len(keys) and self.index < len(self.layers):
+      name,layer = self.layers[self.index]
+      rpc = layer.get_async(keys,self)
+      if not layer.synchronous:
+        self.rpc = rpc
+        self.rpc_keys = keys
+        return
+      keys = self._take(keys,rpc)
+    
+  def _take(self,keys,rpc):
+    '''Takes the results of the current layer and moves to the next one
+    
+    Returns:
+      Keys the next layers should read
+    '''
+    name,layer = self.layers[self.index]
+    self.index += 1
+    results = rpc.get_result()
+    missed = self.missed[name] = self._resolve(name,keys,results)
+    if self.refresh_ahead is not None:
+      layer.refresh(self,rpc,results)
+    if len(missed) and self.index < len(self.layers):
+      missed = layer.lease(self,missed)
+    return missed
+  
+  def _soft_expired(self,expiries):
+    '''Keys of an expiration timestamp dictionary that are due for refresh'''
+    deadline = time.time()+self.refresh_ahead
+    return [key for key,expiry in expiries.iteritems() if expiry <= deadline]
+  
+  def _put_tombstones(self):
+    '''Caches tombstones for keys missing from all layers and copies 
+    tombstones to the layers above the one they were found in'''
+    if self.tombstone_expiration is None:
+      return
+    models = self.models
+    if DATASTORE in self.storage:
+      confirmed = lambda key: models.get(key) is None
     else:
-      countdown *= 2
-    deferred.defer(_put,models,countdown,_countdown=countdown)
+      tombstones = frozenset(self.tombstones)
+      confirmed = lambda key: key in tombstones
+    for name,layer in self.layers:
+      targets = [key for key in self.missed.get(name,()) if confirmed(key)]
+      if len(targets):
+        layer.put_tombstones(self,targets)
+        _count('tombstones_written',len(targets))
+  
+  def get_result(self):
+    if self.done:
+      return self.result
+    while self.rpc is not None:
+      rpc,self.rpc = self.rpc,None
+      self._read(self._take(self.rpc_keys,rpc))
+    
+    self._put_tombstones()
+    models = self.models
+    for name,layer in self.layers:
+      if name in self.missed:
+        layer.fill(self,[models[key] for key in self.missed[name] 
+                         if models.get(key) is not None])
+    
+    if _scope.depth:
+      _scope.models.update((key,model) for key,model in models.iteritems()
+                           if model is not None)
+    
+    for key in self.keys:
+      if key not in models:
+        models[key] = None
+    self.result = _format_result(self.keys,models,self.result_type)
+    self.done = True
+    return self.result
+
+class _AsyncPut(object):
+  '''pdb.put pipeline, memcache and datastore writes are in flight together.
+  
+  Models without complete keys are written to datastore first, cache layers
+  are written in get_result() once datastore assigns their keys.
+  
+  With write_behind datastore writes are journaled, see WRITE_BEHIND.
+  With skip_unchanged unchanged models aren't written, see SKIP_UNCHANGED.
+  '''
+  def __init__(self,models,storage,local_expiration,memcache_expiration,
+               write_behind=False,skip_unchanged=False):
+    _wait_pending()
+    self.models = [model for model in _to_list(models) if model is not None]
+    self.given = self.models
+    self.skipped = []
+    self.skip_unchanged = skip_unchanged
+    self.encoded = {}
+    if skip_unchanged and DATASTORE in storage:
+      self.models,self.skipped,self.encoded = _split_unchanged(self.models)
+      if len(self.skipped):
+        _count('skipped_writes',len(self.skipped))
+    self.storage = storage
+    self.local_expiration = local_expiration
+    self.memcache_expiration = memcache_expiration
+    self.keys = []
+    self.db_rpc = None
+    self.memcache_rpc = None
+    self.retry_rpc = None
+    self.done = False
+    
+    try: 
+      keys = _to_dict(self.models).keys()
+      self.saved = True
+    except db.NotSavedError:
+      if DATASTORE not in storage or write_behind:
+        raise IdentifierNotFoundError() 
+      self.saved = False
+      
+    if DATASTORE in storage:
+      if self.saved and len(keys):
+        self.retry_rpc = _supersede_retries_async(keys)
+      if write_behind and _write_behind(self.models):
+        self.keys = [model.key() for model in self.models]
+        self._clear_cache(self.keys)
+      else:
+        self.db_rpc = _PutRPC(self.models,
+                              sizes=dict((key,size) for key,(fingerprint,size) 
+                                         in self.encoded.iteritems()))
+    if self.saved:
+      self._put_cache(self.models)
+      if _scope.depth:
+        _scope.models.update(_to_dict(self.given))
+  
+  def _put_cache(self,models):
+    if LOCAL in self.storage:
+      self.keys = _cachepy_put(models,self.local_expiration)
+    if MEMCACHE in self.storage:
+      self.memcache_rpc = _memcache_put_async(models,self.memcache_expiration)
+      self.keys = [model.key() for model in models]
       
+  def _clear_cache(self,keys):
+    '''Removes tombstones and outdated models of written keys from the
+    cache layers this put doesn't write'''
+    keys = map(_key_str,keys)
+    if LOCAL not in self.storage:
+      _cachepy_delete(keys)
+    if MEMCACHE not in self.storage:
+      _fire_and_forget(_memcache_delete_async(keys))
+  
+  def _written(self):
+    '''Fingerprints the models that were written and adds the keys of 
+    skipped models to the result in argument order. Without skip_unchanged
+    fingerprints are dropped, they no longer match datastore.'''
+    written = frozenset(map(str,self.keys))
+    for model in self.models:
+      if not isinstance(model,pdb.Model):
+        continue
+      if not self.skip_unchanged:
+        model._fingerprint = None
+      elif model.has_key() and str(model.key()) in written:
+        #Keys of models that weren't saved changed in the write
+        encoded = self.encoded.get(id(model)) if self.saved else None
+        model._fingerprint = encoded[0] if encoded else _fingerprint(model)
+    if len(self.skipped):
+      skipped = frozenset(map(id,self.skipped))
+      self.keys = [model.key() for model in self.given if id(model) in skipped or
+                   (model.has_key() and str(model.key()) in written)]
+  
+  def get_result(self):
+    if self.done:
+      return self.result
+    #Retries are superseded before a failed write of this put spills again
+    if self.retry_rpc is not None:
+      self.retry_rpc.get_result()
+    if self.db_rpc is not None:
+      self.keys = self.db_rpc.get_result()
+      if not self.saved and (LOCAL in self.storage or MEMCACHE in self.storage):
+        models = [model for model in db.get(self.keys) if model is not None]
+        self._put_cache(models)
+      if not self.saved and _scope.depth:
+        _scope.models.update(_to_dict(self.given))
+      if len(self.keys):
+        self._clear_cache(self.keys)
+    if self.memcache_rpc is not None:
+      self.memcache_rpc.get_result()
+    if DATASTORE in self.storage:
+      self._written()
+    self.result = _normalize_keys(self.keys)
+    self.done = True
+    return self.result
+
+class _Done(object):
+  '''Result of a pdb call that has nothing to wait for'''
+  def __init__(self,result=None):
+    self.result = result
+    
+  def get_result(self):
+    return self.result
+
+class _BatchBuffer(threading.local):
+  '''Puts and deletes buffered by pdb.batch in this thread, 
+  key string: (operation,model,arguments) in write order'''
+  def __init__(self):
+    self.depth = 0
+    self.writes = OrderedDict()
+
+_batch = _BatchBuffer()
+
+class _Batch(object):
+  '''Context manager returned by pdb.batch, nested batches join the outermost one'''
+  def __enter__(self):
+    _batch.depth += 1
+    return self
+  
+  def __exit__(self,type,value,traceback):
+    _batch.depth -= 1
+    if _batch.depth == 0:
+      _flush_batch()
+    return False
+
+def _buffer_write(key,operation,model,arguments):
+  #Last write of a key wins and moves to the end of the write order
+  _batch.writes.pop(key,None)
+  _batch.writes[key] = (operation,model,arguments)
+
+def _batch_lookup(keys,storage):
+  '''Returns a key-model dictionary of the buffered writes of given keys to
+  given storage layers, deleted keys map to None'''
+  result = {}
+  if not _batch.writes:
+    return result
+  for key in keys:
+    try:
+      operation,model,arguments = _batch.writes[key]
+    except KeyError:
+      continue
+    if any(layer in arguments[0] for layer in storage):
+      result[key] = model
+  return result
+
+def _flush_batch():
+  '''Writes buffered puts and deletes with one pipeline per set of arguments'''
+  writes = _batch.writes
+  if not writes:
+    return
+  _batch.writes = OrderedDict()
+  puts = OrderedDict()
+  deletes = OrderedDict()
+  for key,(operation,model,arguments) in writes.iteritems():
+    if operation == 'put':
+      puts.setdefault(arguments,[]).append(model)
+    else:
+      deletes.setdefault(arguments,[]).append(key)
+  rpcs = []
+  for (storage,local_expiration,memcache_expiration,write_behind,skip_unchanged),models \
+      in puts.iteritems():
+    rpcs.append(_AsyncPut(models,list(storage),local_expiration,
+                          memcache_expiration,write_behind,skip_unchanged))
+  for (storage,),keys in deletes.iteritems():
+    rpcs.append(_AsyncDelete(keys,list(storage)))
+  for rpc in rpcs:
+    rpc.get_result()
+
+class BatchMiddleware(object):
+  '''WSGI middleware that runs each request in a pdb.batch and calls 
+  pdb.wait_all when it ends'''
+  def __init__(self,app):
+    self.app = app
+    
+  def __call__(self,environ,start_response):
+    try:
+      with pdb.batch():
+        return self.app(environ,start_response)
+    finally:
+      pdb.wait_all()
+
+class _RequestScope(threading.local):
+  '''Identity map of the pdb.request_scope of this thread, key string: model'''
+  def __init__(self):
+    self.depth = 0
+    self.models = {}
+
+_scope = _RequestScope()
+
+class _Scope(object):
+  '''Context manager returned by pdb.request_scope, nested scopes join the 
+  outermost one'''
+  def __enter__(self):
+    _scope.depth += 1
+    return self
+  
+  def __exit__(self,type,value,traceback):
+    _scope.depth -= 1
+    if _scope.depth == 0:
+      _scope.models = {}
+    return False
+
+def _scope_lookup(keys):
+  '''Returns a key-model dictionary of given keys found in the request scope'''
+  models = _scope.models
+  return dict((key,models[key]) for key in keys if key in models)
+
+class RequestScopeMiddleware(object):
+  '''WSGI middleware that runs each request in a pdb.request_scope and calls
+  pdb.wait_all when it ends'''
+  def __init__(self,app):
+    self.app = app
+    
+  def __call__(self,environ,start_response):
+    try:
+      with pdb.request_scope():
+        return self.app(environ,start_response)
+    finally:
+      pdb.wait_all()
+
+class _AsyncDelete(object):
+  '''pdb.delete pipeline, memcache and datastore deletes are in flight together'''
+  def __init__(self,keys,storage):
+    _wait_pending()
+    keys = map(_key_str, _to_list(keys))
+    #Fingerprinted models of deleted kinds no longer match datastore,
+    #only kinds that were fingerprinted have an epoch
+    if len(_delete_epochs):
+      for kind in set(db.Key(key).kind() for key in keys):
+        if kind in _delete_epochs:
+          _delete_epochs[kind] += 1
+    for key in keys:
+      _scope.models.pop(key,None)
+    self.rpcs = []
+    if DATASTORE in storage:
+      self.rpcs.append(db.delete_async(keys))
+    if MEMCACHE in storage:
+      self.rpcs.append(_memcache_delete_async(keys))
+    if LOCAL in storage:
+      _cachepy_delete(keys)
+      
+  def get_result(self):
+    for rpc in self.rpcs:
+      rpc.get_result()
+    self.rpcs = []
   
 class pdb(object):
   '''Wrapper class for google.appengine.ext.db with seamless cache support'''
@@ -211,6 +1859,8 @@ class pdb(object):
           _local_expiration = LOCAL_EXPIRATION,
           _memcache_expiration = MEMCACHE_EXPIRATION,
           _result_type=LIST,
+          _tombstone_expiration = None,
+          _refresh_ahead = None,
           **kwds):
     """Fetch the specific Model instance with the given keys from 
     given storage layers in given format. 
@@ -226,6 +1876,12 @@ class pdb(object):
       _memcache_expiration: Time for memcache expiration in seconds
                               'memcache' is not in _storage parameters.
       _result_type: format of the result 
+      _tombstone_expiration: Time in seconds cache layers remember that
+                              a key is not in datastore, TOMBSTONE_EXPIRATION
+                              by default, False turns it off.
+      _refresh_ahead: Cached models this many seconds away from expiration
+                              are refreshed in the background, REFRESH_AHEAD 
+                              by default, False turns it off.
       
       Inherited:
         keys: Key within datastore entity collection to find; or string key;
@@ -249,70 +1905,74 @@ class pdb(object):
       KeyParameterError: If something other than db.Key or string repr.
         of db.Key is given
     """
+    return pdb.get_async(keys,_storage,_local_expiration,_memcache_expiration,
+                         _result_type,_tombstone_expiration,_refresh_ahead,
+                         **kwds).get_result()
+  
+  @classmethod
+  def get_async(cls,keys,_storage = None,
+                _local_expiration = LOCAL_EXPIRATION,
+                _memcache_expiration = MEMCACHE_EXPIRATION,
+                _result_type=LIST,
+                _tombstone_expiration = None,
+                _refresh_ahead = None,
+                **kwds):
+    """Asynchronous version of pdb.get, local cache is read and memcache
+    lookup is started right away.
+    
+    Args:
+      See pdb.get
+    
+    Returns:
+      An object whose get_result() method returns what pdb.get returns.
+    """
     if _storage is None:
       _storage = [MEMCACHE,DATASTORE]
     else:
       _storage = _to_list(_storage)
-      _validate_storage(_storage)
+      _validate_storage(_storage,GET_LAYERS)
+    if _tombstone_expiration is None:
+      _tombstone_expiration = TOMBSTONE_EXPIRATION
+    if _tombstone_expiration is False:
+      _tombstone_expiration = None
+    return _AsyncGet(keys,_storage,_local_expiration,_memcache_expiration,
+                     _result_type,_tombstone_expiration,
+                     _refresh_window(_refresh_ahead))
+  
+  @classmethod
+  def iget(cls,keys,batch_size = None,
+           _storage = None,
+           _local_expiration = LOCAL_EXPIRATION,
+           _memcache_expiration = MEMCACHE_EXPIRATION,
+           _tombstone_expiration = None,
+           _refresh_ahead = None):
+    '''Generator version of pdb.get for very large numbers of keys.
     
-    keys = map(_key_str,_to_list(keys))
-    old_keys = keys
-    local_not_found = []
-    memcache_not_found = []
-    local_flag = True if LOCAL in _storage else False
-    memcache_flag = True if MEMCACHE in _storage else False
-    models = {}
-    
-    if local_flag:
-      models = dict(models,**_cachepy_get(keys))
-      keys = none_filter(models)
-      local_not_found = keys
-          
-    if memcache_flag and len(keys):
-      models = dict(models,**_memcache_get(keys))
-      keys = none_filter(models)
-      memcache_not_found = keys
-    
-    if DATASTORE in _storage and len(keys):
-      db_results = [model for model in db.get(keys) if model is not None]
-      if len(db_results):
-        models  = dict(models,**_to_dict(db_results))
-        
-    if local_flag:
-      targets = _dict_multi_get(local_not_found, models)
-      if len(targets):
-        pdb.put(targets,_storage = LOCAL,
-                _local_expiration = _local_expiration,**kwds)  
-    
-    if memcache_flag:
-      targets = _dict_multi_get(memcache_not_found,models)
-      if len(targets):  
-        pdb.put(targets,_storage = MEMCACHE,
-                _memcache_expiration = _memcache_expiration,**kwds)
-        
-    result = []    
-    if _result_type == LIST:
-      #Restore the order of entities   
-      for key in old_keys:
-        try:
-          result.append(models[key])
-        except KeyError:
-          result.append(None)   
-      #Normalized result
-      if len(result) > 1 or len(result) == 0:
-        return result
-      else:
-        return result[0]
-    elif _result_type == DICT:
-      return models
-    elif _result_type == NAME_DICT:
-      result = {}
-      for k,v in models.iteritems():
-        result[_id_or_name(k)] = v
-      return result
-    else:
-      raise ResultTypeError(_result_type)
-        
+    Keys are read in windows of batch_size keys, IGET_BATCH_SIZE by default,
+    through the same storage layers and refills as pdb.get. The next window 
+    is started before the models of the current one are yielded, so only 
+    two windows are in memory at a time. Keys can be any iterable.
+    
+    Args:
+      batch_size: Number of keys in a window
+      See pdb.get for the others
+      
+    Yields:
+      Model instances or None in key order
+    '''
+    windows = _windows(keys,batch_size or IGET_BATCH_SIZE)
+    start = lambda window: pdb.get_async(window,_storage,_local_expiration,
+                                         _memcache_expiration,DICT,
+                                         _tombstone_expiration,_refresh_ahead)
+    window = next(windows,None)
+    rpc = window and start(window)
+    while rpc is not None:
+      window = next(windows,None)
+      next_rpc = window and start(window)
+      models = rpc.get_result()
+      for key in rpc.keys:
+        yield models[key]
+      rpc = next_rpc
 
   @classmethod
   def put(cls,models,_storage = None,
@@ -325,11 +1985,18 @@ class pdb(object):
     They are first written into datastore and then saved to other storage layers
     using the keys returned by datastore put() operation.
     
+    When datastore is written, cached copies and tombstones of the models
+    in the other cache layers are removed.
+    
     Args:
 
       _storage: string or array of strings for target storage layers  
       _local_expiration: Time in seconds for local cache expiration for models
       _memcache_expiration: Time in seconds for memcache expiration for models
+      _write_behind: If True datastore write is left to the flush of the
+        current write behind window, WRITE_BEHIND by default
+      _skip_unchanged: If True pdb.Model instances that haven't changed since 
+        they were loaded or put aren't written, SKIP_UNCHANGED by default
     
       Inherited:
         models: Model instance or list of Model instances.
@@ -340,49 +2007,55 @@ class pdb(object):
     
     Raises:
       IdentifierNotFoundError if models has no key names 
-      and are being written into cache storage only.
+      and are being written into cache storage only or written behind.
     
       Inherited:
         TransactionFailedError if the data could not be committed.
     '''
 
-    keys = [] 
-    models = _to_list(models)   
-    models = [model for model in models if model is not None]
+    return pdb.put_async(models,_storage,_local_expiration,_memcache_expiration,
+                         **kwds).get_result()
+  
+  @classmethod
+  def put_async(cls,models,_storage = None,
+                _local_expiration = LOCAL_EXPIRATION,
+                _memcache_expiration = MEMCACHE_EXPIRATION,
+                _write_behind = None,
+                _skip_unchanged = None,
+                **kwds):
+    '''Asynchronous version of pdb.put, memcache and datastore writes 
+    are started right away.
+    
+    Args:
+      See pdb.put
+    
+    Returns:
+      An object whose get_result() method returns what pdb.put returns.
+    '''
     if _storage is None:
       _storage = [MEMCACHE,DATASTORE]
     else:
       _storage = _to_list(_storage)
       _validate_storage(_storage)
-    
-    try: 
-      _to_dict(models)
-    except db.NotSavedError:
-      if DATASTORE in _storage:
-        keys = _put(models)
-        models = db.get(keys)
-        _storage.remove(DATASTORE)
-        if len(_storage):
-          return pdb.put(models,_storage,**kwds)
-      else: 
-        raise IdentifierNotFoundError() 
-    
-    if DATASTORE in _storage:
-      keys = _put(models)
-      
-    if LOCAL in _storage:
-      keys = _cachepy_put(models, _local_expiration)
-
-    if MEMCACHE in _storage:
-      keys = _memcache_put(models,_memcache_expiration)
-      
-    if len(keys) > 1:
-      return keys
-    elif len(keys):
-      return keys[0]
-    else:
-      return None
-
+    if _write_behind is None:
+      _write_behind = WRITE_BEHIND
+    if _skip_unchanged is None:
+      _skip_unchanged = SKIP_UNCHANGED
+    if _batch.depth:
+      models = [model for model in _to_list(models) if model is not None]
+      try:
+        keys = [_key_str(model) for model in models]
+      except db.NotSavedError:
+        #Datastore has to assign keys, so these are written right away
+        keys = None
+      if keys is not None:
+        arguments = (tuple(_storage),_local_expiration,_memcache_expiration,
+                     _write_behind,_skip_unchanged)
+        for key,model in zip(keys,models):
+          _buffer_write(key,'put',model,arguments)
+        return _Done(_normalize_keys([model.key() for model in models]))
+    return _AsyncPut(models,_storage,_local_expiration,_memcache_expiration,
+                     _write_behind,_skip_unchanged)
 
   @classmethod
   def delete(cls,keys,_storage = None):
@@ -395,21 +2068,242 @@ class pdb(object):
         models: Model instance, key, key string or iterable thereof.
         config: datastore_rpc.Configuration to use for this request.
     """
-    keys = map(_key_str, _to_list(keys))
+    pdb.delete_async(keys,_storage).get_result()
+  
+  @classmethod
+  def delete_async(cls,keys,_storage = None):
+    """Asynchronous version of pdb.delete
+    
+    Returns:
+      An object whose get_result() method waits for the deletes to finish.
+    """
     if _storage is None:
       _storage = ALL_LEVELS
     else:
       _storage = _to_list(_storage)
       _validate_storage(_storage)
+    if _batch.depth:
+      for key in map(_key_str,_to_list(keys)):
+        _buffer_write(key,'delete',None,(tuple(_storage),))
+      return _Done()
+    return _AsyncDelete(keys,_storage)
+  
+  @classmethod
+  def batch(cls):
+    '''Returns a context manager that buffers pdb.put and pdb.delete calls of
+    the current thread and writes them when it exits, see BatchMiddleware to 
+    batch whole requests.
+    
+    Only the last write of a key is kept, writes with the same storage layers
+    and expirations are written together. pdb.get calls in the context see 
+    buffered writes. Models without complete keys are written right away.
     
-    if DATASTORE in _storage:
-      db.delete(keys)
+    Usage:
+      with pdb.batch():
+        for model in models:
+          model.count += 1
+          model.put()
+    '''
+    return _Batch()
+  
+  @classmethod
+  def prefetch_refs(cls,models,*reference_names,**kwds):
+    '''Resolves the ReferenceProperties of models with one pdb.get per
+    level of references instead of one per model. Referenced keys are 
+    de-duplicated and resolved models are attached to the properties, so 
+    reading them or calling cached_ref afterwards doesn't look them up.
+    
+    Usage:
+      #Resolves comment.author for all comments and author.company 
+      #for all authors with two pdb.get calls
+      pdb.prefetch_refs(comments,'author.company')
+      for comment in comments:
+        comment.cached_ref('author').cached_ref('company')
+    
+    Args:
+      models: Model instance or list of Model instances
+      reference_names: Reference property names, dotted names for
+        references of referenced models.
+      See pdb.get for the keyword arguments
       
-    if LOCAL in _storage:
-      _cachepy_delete(keys)
-
-    if MEMCACHE in _storage:
-      _memcache_delete(keys)
+    Returns:
+      models
+      
+    Raises:
+      ReferenceError: If a model doesn't have a reference property 
+        called by a given name
+    '''
+    kwds.pop('_result_type',None)
+    tree = {}
+    for reference_name in reference_names:
+      branch = tree
+      for name in reference_name.split('.'):
+        branch = branch.setdefault(name,{})
+    level = [(_to_list(models),tree)]
+    while len(level):
+      references = []
+      for level_models,branch in level:
+        for name,children in branch.iteritems():
+          for model in level_models:
+            if model is None:
+              continue
+            property = _reference_property(model,name)
+            key = property.get_value_for_datastore(model)
+            if key is not None:
+              references.append((model,_resolved_attr(property),_key_str(key),children))
+      keys = list(OrderedDict.fromkeys(key for model,attr,key,children in references
+                                       if getattr(model,attr,None) is None))
+      found = pdb.get(keys,_result_type=DICT,**kwds) if len(keys) else {}
+      next_level = OrderedDict()
+      for model,attr,key,children in references:
+        resolved = getattr(model,attr,None)
+        if resolved is None:
+          resolved = found.get(key)
+          if resolved is None:
+            continue
+          setattr(model,attr,resolved)
+        if len(children):
+          next_level.setdefault(id(children),(children,OrderedDict()))[1][key] = resolved
+      level = [(resolved.values(),children) for children,resolved in next_level.itervalues()]
+    return models
+  
+  @classmethod
+  def request_scope(cls):
+    '''Returns a context manager that keeps an identity map of the models 
+    pdb.get, pdb.put and pdb.delete see in the current thread, see 
+    RequestScopeMiddleware to scope whole requests.
+    
+    In the scope pdb.get returns the same instance for the same key before 
+    reading any storage layer, puts replace and deletes remove mapped models.
+    The map is cleared when the outermost scope exits.
+    
+    Usage:
+      with pdb.request_scope():
+        for comment in comments:
+          comment.cached_ref('author')
+    '''
+    return _Scope()
+  
+  @classmethod
+  def wait_all(cls):
+    '''Waits for the cache refills started by pdb.get in this thread and
+    runs the local cache refreshes it queued, call it at the end of a request
+    to make sure they are complete. Buffered pdb.Counter increments are sent 
+    to memcache too.'''
+    _flush_counters()
+    _wait_pending()
+    _run_refreshes()
+    _wait_pending()
+  
+  @classmethod
+  def flush_write_behind(cls):
+    '''Writes the models put with _write_behind in windows that ended at least
+    WRITE_BEHIND_GRACE seconds ago and haven't been flushed yet. Each window is
+    flushed by a task queued with its first write, call this from a cron job 
+    to catch up after task failures.
+    
+    Returns:
+      Number of models written
+    '''
+    current = int(time.time()-WRITE_BEHIND_GRACE)//WRITE_BEHIND_WINDOW
+    windows = range(current-WRITE_BEHIND_EXPIRATION//WRITE_BEHIND_WINDOW,current)
+    counts = memcache.get_multi([_journal_key(window,'count') for window in windows])
+    flushed = memcache.get_multi([_journal_key(window,'flushed') for window in windows])
+    written = 0
+    for window in windows:
+      if _journal_key(window,'count') in counts and \
+          _journal_key(window,'flushed') not in flushed:
+        written += _flush_window(window)
+    return written
+  
+  @classmethod
+  def stats(cls):
+    '''Returns counters of the current instance:
+    
+      local_tombstone_hits: Keys pdb.get answered with a local cache tombstone
+      memcache_tombstone_hits: Keys pdb.get answered with a memcache tombstone
+      tombstones_written: Tombstones written to cache layers
+      leases_granted: Memcache misses this instance took the lease to refill
+      leases_waited: Memcache misses answered by waiting for a lease holder
+      lease_timeouts: Memcache misses read from datastore after waiting
+        for a lease holder in vain
+      local_refreshes: Local cache entries refreshed ahead of their expiration
+      memcache_refreshes: Memcache entries queued for refresh ahead of their expiration
+      write_behind_puts: Models put with _write_behind
+      write_behind_writes: Models written to datastore by write behind flushes
+      skipped_writes: Unchanged models pdb.put didn't write
+      counter_folds: pdb.Counter deltas folded into datastore shards
+      scope_hits: Keys pdb.get answered from the identity map of a request scope
+      retry_spilled: Models spilled to retry chunks after a failed write
+      retry_written: Models written by retry tasks
+      retry_superseded: Spilled models retry tasks skipped for a later write
+    '''
+    with _stats_lock:
+      return dict(_stats)
+  
+  @classmethod
+  def enable_local_stats(cls,enabled=True):
+    '''Turns the local cache stats breakdowns of pdb.local_stats on or off.
+    
+    They are off by default, keys are classified when they are set or missed
+    in the local cache while they are on. Keys already in the cache are 
+    classified right away.
+    '''
+    cachepy.set_classifier(_classify_key if enabled else None)
+  
+  @classmethod
+  def local_stats(cls):
+    '''Returns local cache stats of the current instance, broken down by key class
+    (entity, query, reference_index, other), entity kind and query key root.
+    
+    Each breakdown has hits, misses, hit_ratio, evictions, expirations, 
+    number of keys and approximate bytes. Breakdowns are empty unless 
+    pdb.enable_local_stats was called.
+    
+    Returns:
+      {'total': cachepy.stats(),
+       'classes': {class: stats},
+       'kinds': {kind: stats},
+       'queries': {query key root: stats}}
+    '''
+    result = {'total':cachepy.stats(),'classes':{},'kinds':{},'queries':{}}
+    breakdowns = {'class':'classes','kind':'kinds','query':'queries'}
+    for group,stats in cachepy.group_stats().iteritems():
+      breakdown,name = group.split(':',1)
+      if breakdown in breakdowns:
+        result[breakdowns[breakdown]][name] = stats
+    return result
+  
+  @classmethod
+  def snapshot_local(cls,path):
+    '''Writes the local cache of the current instance to a file, with models
+    and cached query results in protobuf encoded form.
+    
+    Call it before an instance goes away and pdb.load_local on warmup 
+    so new instances don't start with an empty local cache.
+    
+    Args:
+      path: Snapshot file path
+      
+    Returns:
+      Number of cache entries written
+    '''
+    return cachepy.snapshot(path,_snapshot_encode)
+  
+  @classmethod
+  def load_local(cls,path,lazy=True):
+    '''Loads a file written by pdb.snapshot_local into the local cache of
+    the current instance. Entries that have expired since the snapshot are skipped.
+    
+    Args:
+      path: Snapshot file path
+      lazy: If True only the snapshot index is read, each model is decoded
+        the first time it is read from local cache.
+    
+    Returns:
+      Number of cache entries loaded
+    '''
+    return cachepy.load(path,_snapshot_decode,lazy)
   
   
   class Model(db.Model):
@@ -418,6 +2312,15 @@ class pdb(object):
     
     _default_delimiter = '|'
     
+    @classmethod
+    def from_entity(cls,entity,_data=None):
+      '''Fingerprints models loaded from datastore or cache while 
+      SKIP_UNCHANGED is on, _data is the encoded protobuf of the entity'''
+      model = super(pdb.Model,cls).from_entity(entity)
+      if SKIP_UNCHANGED:
+        model._fingerprint = _fingerprint(model,_data)
+      return model
+    
     def put(self,**kwds):
       """Writes this model instance to the given storage layers.
   
@@ -502,8 +2405,8 @@ class pdb(object):
         raise db.BadArgumentError(str(e))
       
       key_names = _to_list(key_names)
-      key_strings = [_key_str(db.Key.from_path(cls.kind(), name, parent=parent))
-        for name in key_names]
+      kind = cls.kind()
+      key_strings = [_path_key_str(kind, name, parent) for name in key_names]
 
       return pdb.get(key_strings,**kwds)
     
@@ -523,8 +2426,8 @@ class pdb(object):
         raise db.BadArgumentError(str(e))
       
       ids = _to_list(ids)
-      key_strings = [_key_str(datastore.Key.from_path(cls.kind(), id, parent=parent))
-        for id in ids]
+      kind = cls.kind()
+      key_strings = [_path_key_str(kind, id, parent) for id in ids]
       
       return pdb.get(key_strings,**kwds)
     
@@ -574,13 +2477,13 @@ class pdb(object):
       '''This function is a wrapper around db.ReferenceProperty
       When a reference name is given this function tries to retrieve 
       the model from given storage layers using the pdb.get function.
+      
+      References resolved by pdb.prefetch_refs are returned without a lookup.
       '''
-      try:
-        property = self.properties()[reference_name]
-      except KeyError:
-        raise ReferenceError(reference_name, ReferenceError.REFERENCE_NAME_ERROR)
-      if not isinstance(property, db.ReferenceProperty):
-        raise ReferenceError(property.__class__.__name__,ReferenceError.TYPE_ERROR)
+      property = _reference_property(self,reference_name)
+      resolved = getattr(self,_resolved_attr(property),None)
+      if resolved is not None:
+        return resolved
 
       try:
         kwds.pop('_result_type') #Use default result for pdb.get
@@ -672,6 +2575,71 @@ class pdb(object):
       else:
         logging.info(result)
         
+  class Counter(object):
+    '''Counter for hot write patterns like views and scores. Increments are
+    pre-aggregated in the instance, added to memcache with incr and folded 
+    into one of a number of sharded datastore entities periodically, so 
+    writers don't contend on a single entity. See COUNTER_SHARDS.
+    
+    Counters with a period count in time_util periods, every period is
+    a separate counter named after the time it ends.
+    
+    Increments are sent to memcache by the first incr, value or other pdb 
+    call of the instance COUNTER_BUFFER_TIME seconds after the last send, and
+    by pdb.wait_all. Until then only the instance that buffered them sees
+    them, and they are lost if the instance shuts down.
+    
+    Usage:
+      views = pdb.Counter('views|'+page_id)
+      views.incr()
+      views.value()
+      
+      #Counts in 10 minute buckets
+      hits = pdb.Counter('hits',period='minute',period_length=10)
+      hits.incr()
+      hits.value(at=datetime(2011,1,1,15,23))
+    '''
+    PERIODS = ('minute','hour','day')
+    
+    def __init__(self,name,shards=None,period=None,period_length=1):
+      if period is not None and period not in self.PERIODS:
+        raise CounterPeriodError(period)
+      self.name = name
+      self.shards = shards or COUNTER_SHARDS
+      self.period = period
+      self.period_length = period_length
+      
+    def _bucket(self,at=None):
+      if self.period is None:
+        return self.name
+      if at is None:
+        at = time_util.now()
+      expiration = getattr(time_util,self.period+'_expiration')(self.period_length,
+                                                                _test_datetime=at)
+      end = at+timedelta(seconds=expiration)
+      return '%s|%s' % (self.name,end.strftime('%Y%m%d%H%M'))
+      
+    def incr(self,delta=1):
+      '''Adds delta to the counter of the current period'''
+      _buffer_count(self._bucket(),self.shards,delta)
+      
+    def value(self,at=None):
+      '''Returns the counter value of the period at given datetime,
+      current period by default. Values are approximate for 
+      COUNTER_SUM_EXPIRATION seconds after a fold.'''
+      _flush_stale_counters()
+      name = self._bucket(at)
+      sum_key = _counter_key(name,'sum')
+      cached = memcache.get_multi([sum_key,_counter_key(name,'delta')])
+      if sum_key in cached:
+        total = int(cached[sum_key])-_COUNTER_BIAS
+      else:
+        shards = db.get(_shard_keys(name,self.shards))
+        total = sum(shard.count for shard in shards if shard is not None)
+        memcache.add(sum_key,total+_COUNTER_BIAS,COUNTER_SUM_EXPIRATION)
+      delta = int(cached.get(_counter_key(name,'delta'),_COUNTER_BIAS))-_COUNTER_BIAS
+      return total+delta+_buffered_count(name)
+  
   class GqlQuery(object):
     '''This class is a wrapper that adds cache support to GQL queries
       See Google App Engine docs for basic GqlQuery Usage
@@ -737,11 +2705,15 @@ class pdb(object):
           result2= query.fetch(100,_cache='memcache')
     '''
     delim  = '|'
+    key_prefix = 'GQL_'
     limit_key = '__limit__'
     offset_key = '__offset__'
     
     def __init__(self,query_string,*args,**kwds):
-      self.key_name = 'GQL_'+str(hash(query_string))
+      self.key_name = self.__class__.key_prefix+str(hash(query_string))
+      self.query_string = query_string
+      self.args = ()
+      self.kwds = {}
       self.query = db.GqlQuery(query_string,*args,**kwds)
       if args or kwds:
         self.bind(*args,**kwds)
@@ -800,6 +2772,9 @@ class pdb(object):
       self._clear_keyname()
       self._create_suffix(*args,**kwds)
       self.query.bind(*args,**kwds)
+      #Kept to rebuild the query for background refreshes
+      self.args = args
+      self.kwds = kwds
       
     def cursor(self):
       '''Returns the query cursor after a datastore query operation'''
@@ -823,7 +2798,8 @@ class pdb(object):
     def fetch(self,limit,offset=0,
               _cache=None,
               _local_expiration = QUERY_EXPIRATION,
-              _memcache_expiration = QUERY_EXPIRATION):
+              _memcache_expiration = QUERY_EXPIRATION,
+              _refresh_ahead = None):
       '''By default this method runs the query on datastore.
       
       If additonal parameters are supplied, it tries to retrieve query
@@ -842,6 +2818,9 @@ class pdb(object):
           a cache refresh operation is run.         
         _memcache_expiration: Expiration in seconds for memcache,
           if a cache refresh operation is run.
+        _refresh_ahead: Cached results this many seconds away from expiration
+          are refreshed in the background, REFRESH_AHEAD by default, 
+          False turns it off.
         
       Returns:
         The return value is a list of model instances, possibly an empty list.
@@ -849,7 +2828,9 @@ class pdb(object):
       Raises:
         CacheLayerError: If an invalid cache layer name is supplied
       '''
+      _wait_pending()
       klass = self.__class__
+      _refresh_ahead = _refresh_window(_refresh_ahead)
       if _cache is None:
         _cache = []
       else:
@@ -867,18 +2848,41 @@ class pdb(object):
       if offset != 0:
         self._concat_keyname(klass.offset_key+str(offset))
 
+      refresh_args = (self.query_string,self.args,tuple(sorted(self.kwds.items())),
+                      limit,offset)
       if local_flag:
         result = cachepy.get(self.key_name)
+        if result is not None and _refresh_ahead is not None:
+          expiry = cachepy.expiries([self.key_name]).get(self.key_name)
+          if expiry is not None and expiry <= time.time()+_refresh_ahead:
+            _refresh_later(self.key_name,_refresh_local_query,
+                           refresh_args+(memcache_flag,_local_expiration,
+                                         _memcache_expiration))
 
+      leased = False
       if memcache_flag and result is None:
-        result = _deserialize(memcache.get(self.key_name))
+        value,expiry = _unwrap_expiry(_memcache_get_value(self.key_name))
+        result = _deserialize(value)
+        if result is not None and _refresh_ahead is not None and \
+            expiry is not None and expiry <= time.time()+_refresh_ahead:
+          _refresh_in_background([self.key_name],_refresh_query,
+                                 *(refresh_args+(_memcache_expiration,)))
+        if result is None:
+          #Only the lease holder runs the query and refills memcache
+          granted,contended = _acquire_leases([self.key_name])
+          leased = bool(granted)
+          if contended:
+            result = _deserialize(_wait_leases(contended).get(self.key_name))
         if local_flag and result is not None:
           cachepy.set(self.key_name,result,_local_expiration)
       
       if result is None:
         result = self.query.fetch(limit,offset)
-        if memcache_flag:
-          memcache.set(self.key_name,_serialize(result),_memcache_expiration)
+        if leased:
+          _memcache_set_value(self.key_name,
+                              _wrap_expiry(_serialize(result),_memcache_expiration),
+                              _memcache_expiration)
+          _release_leases([self.key_name])
         if local_flag:
           cachepy.set(self.key_name,result,_local_expiration)
       
@@ -993,6 +2997,14 @@ class _ReferenceCacheIndex(pdb.Model):
                _memcache_expiration = _memcache_expiration)    
     return entity
 
+class _CounterShard(pdb.Model):
+  '''Datastore shard of a pdb.Counter'''
+  count = db.IntegerProperty(default = 0,indexed = False)
+
+class _RetryChunk(db.Model):
+  '''Encoded models waiting for a datastore write retry, see _spill'''
+  models = db.ListProperty(db.Blob,indexed = False)
+
 class ResultTypeError(Exception):
   def __init__(self,type):
     self.type = type
@@ -1028,6 +3040,12 @@ class KeyParameterError(Exception):
   def __str__(self):
       return  '%s was given as function parameter, it should be db.Key,String or db.Model' %self.type
        
+class CounterPeriodError(Exception):
+  def __init__(self,period):
+    self.period = period
+  def __str__(self):
+    return  'Counter period invalid: %s. Valid values are "minute", "hour" and "day"' %self.period
+  
 class IdentifierNotFoundError(Exception):
     def __str__(self):
         return  'Error trying to write models into cache without valid identifiers. Try enabling datastore write for the models or use keynames instead of IDs.'
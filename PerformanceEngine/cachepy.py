@@ -14,17 +14,27 @@ Not everything are upsides. You can not use it on every case because:
   with Cachepy happens in the instance of the current request and you have N instances, be aware of that.
 - The only way to be sure you have flushed all the GAE instances caches is doing a code upload, no code change required. 
 - The memory available depends on each GAE instance and your app. I've been able to set a 60 millions characters string which
-  is like 57 MB at least. You can cache somethings but not everything. 
+  is like 57 MB at least. You can cache somethings but not everything. Use configure() to give the cache a memory
+  budget (bytes and/or number of keys), least recently used keys are evicted to stay under it.
+
+The cache is safe to use from threadsafe instances. Keys are spread over SHARD_COUNT shards, each one with its own lock,
+LRU order and counters, so concurrent requests only contend when they touch the same shard. The memory budget is
+shared by the whole cache, see configure().
 """
 
+import functools
+import heapq
+import inspect
 import time
 import logging
 import os
+import struct
+import sys
+import cPickle as pickle
+import threading
+import __builtin__
 
-CACHE = {}
-STATS_HITS = 0
-STATS_MISSES = 0
-STATS_KEYS_COUNT = 0
+from collections import OrderedDict
 
 """ Flag to deactivate it on local environment. """
 ACTIVE = True#False if os.environ.get('SERVER_SOFTWARE').startswith('Devel') else True
@@ -35,34 +45,383 @@ Value in seconds.
 """
 DEFAULT_CACHING_TIME = None
 
+"""
+Memory budget of the instance cache, least recently used keys are evicted when it is exceeded.
+A value bigger than MAX_BYTES is never cached. None means unbounded. See configure().
+"""
+MAX_BYTES = None
+MAX_KEYS = None
+
+""" Keys and bytes of the whole cache, changed holding _USAGE_LOCK """
+_USAGE = {'keys': 0, 'bytes': 0}
+_USAGE_LOCK = threading.Lock()
+
+""" How deep sizeof() follows containers and object attributes """
+SIZEOF_DEPTH = 4
+
+""" Number of lock stripes, a power of two """
+SHARD_COUNT = 16
+
+""" Maximum number of expired entries reclaimed by each operation on a shard """
+SWEEP_BATCH = 8
+
 URL_KEY = 'URL_%s'
 
 """
-Curious thing: A dictionary in the global scope can be referenced and changed inside a function without using the global statement,
-but it can not be redefined.
+Called with a key, returns the names of the groups the key is counted in by group_stats().
+None means no group stats. See set_classifier().
 """
+CLASSIFIER = None
+GROUP_STATS = ( 'hits', 'misses', 'evictions', 'expirations', 'keys', 'bytes' )
+
+""" Returned by shards on a miss, None is a valid cached value """
+_MISSING = object()
+
+""" Passed to _Shard.expire to reclaim every expired entry """
+_UNBOUNDED = object()
+
+class _Shard( object ):
+    """
+    A slice of the instance cache guarded by its own lock.
+    Entries are kept in least recently used order, the first key is the next one to be evicted.
+    Keys with an expiry are also pushed to a min-heap of ( expiry, key ) pairs, so expired entries can be
+    reclaimed without waiting for someone to read them. Overwritten or deleted keys leave stale pairs in
+    the heap, they are skipped when popped and the heap is rebuilt once they outnumber the live ones.
+    Counters are only changed while holding the lock. Keys are classified outside of the lock when they are
+    set and their groups are kept in tags, so group counters of a cached key never call the classifier.
+    """
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.expiries = []
+        self.groups = {}
+        self.tags = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.reclaimed = 0
+        self.reclaimed_bytes = 0
+    
+    def count( self, groups, stat, value = 1 ):
+        """ Adds value to the stat of every group """
+        for group in groups:
+            try:
+                self.groups[group][stat] += value
+            except KeyError:
+                self.groups[group] = dict.fromkeys( GROUP_STATS, 0 )
+                self.groups[group][stat] += value
+    
+    def get( self, key, now ):
+        """
+        Must be called holding the lock, returns _MISSING if the key isn't found or has expired.
+        Misses are counted in the groups of the key by _count_misses(), once the lock is released.
+        """
+        self.expire( now )
+        try:
+            value, expiry = self.entries.pop( key )
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+        if expiry == None or now < expiry:
+            self.hits += 1
+            self.count( self.tags.get( key, () ), 'hits' )
+            """ Reinsert it at the most recently used end """
+            self.entries[key] = ( value, expiry )
+            return value
+        self.misses += 1
+        self.reclaim( key )
+        return _MISSING
+    
+    def set( self, key, value, expiry, size, now, groups = () ):
+        """
+        Must be called holding the lock, returns False if the value doesn't fit in MAX_BYTES.
+        groups are the stats groups of the key, see _classify().
+        The least recently used keys of the shard are evicted to make room, callers release the lock
+        and call _enforce_budget() in case that wasn't enough.
+        """
+        self.expire( now )
+        max_bytes = MAX_BYTES
+        if max_bytes is not None and size > max_bytes:
+            """ It would evict the whole cache and itself """
+            self.delete( key )
+            return False
+        if key in self.entries:
+            del self.entries[key]
+            self.forget( key )
+        self.entries[key] = ( value, expiry )
+        self.sizes[key] = size
+        self.bytes += size
+        _account( 1, size )
+        if groups:
+            self.tags[key] = groups
+            self.count( groups, 'keys' )
+            self.count( groups, 'bytes', size )
+        if expiry is not None:
+            heapq.heappush( self.expiries, ( expiry, key ) )
+            if len( self.expiries ) > 2 * len( self.entries ) + 64:
+                self.expiries = [( e, k ) for k, ( v, e ) in self.entries.iteritems() if e is not None]
+                heapq.heapify( self.expiries )
+        self.evict( 1 )
+        return True
+    
+    def expire( self, now, limit = None ):
+        """ 
+        Must be called holding the lock.
+        Reclaims up to limit entries that expired before now, SWEEP_BATCH by default, _UNBOUNDED means no limit.
+        """
+        if limit is None:
+            limit = SWEEP_BATCH
+        elif limit is _UNBOUNDED:
+            limit = None
+        heap = self.expiries
+        while heap and heap[0][0] <= now and limit != 0:
+            expiry, key = heapq.heappop( heap )
+            entry = self.entries.get( key )
+            if entry is not None and entry[1] == expiry:
+                del self.entries[key]
+                self.reclaim( key )
+                if limit is not None:
+                    limit -= 1
+    
+    def forget( self, key ):
+        """ Accounts for an entry that has just been removed from entries, returns its size and groups """
+        size = self.sizes.pop( key, 0 )
+        self.bytes -= size
+        _account( -1, -size )
+        groups = self.tags.pop( key, () )
+        self.count( groups, 'keys', -1 )
+        self.count( groups, 'bytes', -size )
+        return size, groups
+    
+    def reclaim( self, key ):
+        """ Accounts for an expired entry that has just been removed from entries """
+        size, groups = self.forget( key )
+        self.reclaimed += 1
+        self.reclaimed_bytes += size
+        self.count( groups, 'expirations' )
+    
+    def delete( self, key ):
+        """ Must be called holding the lock """
+        if key in self.entries:
+            del self.entries[key]
+            self.forget( key )
+    
+    def evict( self, keep = 0 ):
+        """
+        Must be called holding the lock.
+        Drops least recently used keys while the whole cache is over MAX_BYTES or MAX_KEYS and the shard has
+        more than keep keys, returns the number of keys dropped.
+        """
+        evicted = 0
+        while len( self.entries ) > keep and _over_budget():
+            key, _ = self.entries.popitem( last = False )
+            size, groups = self.forget( key )
+            self.evictions += 1
+            self.count( groups, 'evictions' )
+            evicted += 1
+        return evicted
+    
+    def clear( self ):
+        """ Must be called holding the lock """
+        _account( -len( self.entries ), -self.bytes )
+        self.entries.clear()
+        self.sizes.clear()
+        self.tags.clear()
+        del self.expiries[:]
+        self.bytes = 0
+        for stats in self.groups.itervalues():
+            stats['keys'] = stats['bytes'] = 0
+    
+    def regroup( self, tags ):
+        """
+        Must be called holding the lock, replaces the groups of the keys after a classifier change and recounts
+        their keys and bytes. Keys missing from tags were set since they were classified and keep their groups.
+        """
+        previous = self.tags
+        self.groups = {}
+        self.tags = {}
+        for key in self.entries:
+            groups = tags[key] if key in tags else previous.get( key, () )
+            if groups:
+                self.tags[key] = groups
+                self.count( groups, 'keys' )
+                self.count( groups, 'bytes', self.sizes.get( key, 0 ) )
+
+SHARDS = [_Shard() for i in range( SHARD_COUNT )]
+
+def _classify( key ):
+    """ Returns the stats groups of a key, it must be called without holding a shard lock """
+    classifier = CLASSIFIER
+    if classifier is None:
+        return ()
+    return tuple( classifier( key ) )
+
+def _count_misses( shard, keys ):
+    """ Classifies keys that were missed in a shard and counts the misses of their groups """
+    if CLASSIFIER is None or not keys:
+        return
+    groups = [_classify( key ) for key in keys]
+    with shard.lock:
+        for key_groups in groups:
+            shard.count( key_groups, 'misses' )
+
+def _shard( key ):
+    shards = SHARDS
+    return shards[hash( key ) & ( len( shards ) - 1 )]
+
+def _group( keys ):
+    """ Returns the shard list and a shard index - key list dictionary for the given keys """
+    shards = SHARDS
+    mask = len( shards ) - 1
+    groups = {}
+    for key in keys:
+        index = hash( key ) & mask
+        try:
+            groups[index].append( key )
+        except KeyError:
+            groups[index] = [key]
+    return shards, groups
+
+def set_classifier( classifier ):
+    """
+    Sets the function that tells which groups a key belongs to, like a key prefix or the kind of an entity.
+    It must always return the same groups for the same key, it is called when a key is set or missed but
+    never while holding a shard lock. None turns group stats off.
+    Group stats of the entries already in the cache are recounted.
+    """
+    global CLASSIFIER
+    CLASSIFIER = classifier
+    for shard in SHARDS:
+        with shard.lock:
+            keys = list( shard.entries )
+        tags = dict( ( key, _classify( key ) ) for key in keys )
+        with shard.lock:
+            shard.regroup( tags )
+
+def _account( keys, size ):
+    with _USAGE_LOCK:
+        _USAGE['keys'] += keys
+        _USAGE['bytes'] += size
+
+def _over_budget():
+    return ( ( MAX_KEYS is not None and _USAGE['keys'] > MAX_KEYS ) or
+             ( MAX_BYTES is not None and _USAGE['bytes'] > MAX_BYTES ) )
+
+def _enforce_budget( written = None ):
+    """
+    Must be called without holding a shard lock.
+    Evicts the least recently used key of the biggest shard until the whole cache fits in its budget again,
+    for when the shard that was written doesn't have enough keys to evict. The written shard is left alone,
+    it only holds the key that has just been set by then.
+    """
+    while _over_budget():
+        shards = [shard for shard in SHARDS if shard is not written]
+        if not shards:
+            return
+        if MAX_BYTES is not None and _USAGE['bytes'] > MAX_BYTES:
+            shard = max( shards, key = lambda shard: shard.bytes )
+        else:
+            shard = max( shards, key = lambda shard: len( shard.entries ) )
+        with shard.lock:
+            if not shard.evict( len( shard.entries ) - 1 ):
+                return
+
+def configure( max_bytes = None, max_keys = None, shard_count = None ):
+    """
+    Sets the memory budget of the current instance cache, None means unbounded.
+    The budget is shared by all the shards. A write that goes over it evicts the least recently used keys of
+    its own shard, then of the biggest shards, so eviction follows the LRU order of each shard rather than a
+    global one. Entries over the new budget are evicted right away.
+    Changing shard_count (a power of two) drops the cache, do it on instance startup.
+    """
+    global MAX_BYTES, MAX_KEYS, SHARD_COUNT, SHARDS
+    MAX_BYTES = max_bytes
+    MAX_KEYS = max_keys
+    if shard_count is not None and shard_count != SHARD_COUNT:
+        if shard_count < 1 or shard_count & ( shard_count - 1 ):
+            raise ValueError( "shard_count must be a power of two: %s" % shard_count )
+        SHARD_COUNT = shard_count
+        SHARDS = [_Shard() for i in range( SHARD_COUNT )]
+        with _USAGE_LOCK:
+            _USAGE['keys'] = _USAGE['bytes'] = 0
+    _enforce_budget()
+
+def sizeof( value, depth = SIZEOF_DEPTH, seen = None ):
+    """
+    Returns an estimate of the memory used by value in bytes.
+    Containers and instance attributes are followed up to depth levels, shared objects are counted once.
+    """
+    if seen is None:
+        """ set is shadowed by the module level set() """
+        seen = __builtin__.set()
+    if id( value ) in seen:
+        return 0
+    seen.add( id( value ) )
+    try:
+        size = sys.getsizeof( value )
+    except TypeError:
+        size = 64
+    if depth <= 0 or isinstance( value, ( basestring, int, long, float, bool ) ) or value is None:
+        return size
+    depth -= 1
+    if isinstance( value, dict ):
+        for k, v in value.iteritems():
+            size += sizeof( k, depth, seen ) + sizeof( v, depth, seen )
+    elif isinstance( value, ( list, tuple, __builtin__.set, frozenset ) ):
+        for item in value:
+            size += sizeof( item, depth, seen )
+    elif hasattr( value, '__dict__' ):
+        size += sizeof( value.__dict__, depth, seen )
+    return size
 
 def get( key ):
-    """ Gets the data associated to the key or a None """
-    if ACTIVE is False:
-        return None
-        
-    global CACHE, STATS_MISSES, STATS_HITS
-        
     """ Return a key stored in the python instance cache or a None if it has expired or it doesn't exist """
-    if key not in CACHE:
-        STATS_MISSES += 1
+    if ACTIVE is False:
         return None
     
-    value, expiry = CACHE[key]
+    shard = _shard( key )
     current_timestamp = time.time()
-    if expiry == None or current_timestamp < expiry:
-        STATS_HITS += 1
-        return value
-    else:
-        STATS_MISSES += 1
-        delete( key )
+    with shard.lock:
+        value = shard.get( key, current_timestamp )
+    if isinstance( value, _Lazy ):
+        value = _materialize( key, value, current_timestamp )
+    if value is _MISSING:
+        _count_misses( shard, [key] )
         return None
+    return value
+
+def get_multi( keys ):
+    """ 
+    Returns a key-value dictionary of the given keys that are stored in the instance cache and haven't expired,
+    like memcache.get_multi. The clock is read once and each shard is locked once for the whole batch.
+    """
+    result = {}
+    if ACTIVE is False:
+        return result
+    
+    current_timestamp = time.time()
+    shards, groups = _group( keys )
+    for index, shard_keys in groups.iteritems():
+        shard = shards[index]
+        missed = []
+        with shard.lock:
+            for key in shard_keys:
+                value = shard.get( key, current_timestamp )
+                if value is not _MISSING:
+                    result[key] = value
+                else:
+                    missed.append( key )
+        _count_misses( shard, missed )
+    for key, value in result.items():
+        if isinstance( value, _Lazy ):
+            value = _materialize( key, value, current_timestamp )
+            if value is _MISSING:
+                del result[key]
+            else:
+                result[key] = value
+    return result
 
 def set( key, value, expiry = DEFAULT_CACHING_TIME ):
     """
@@ -72,64 +431,439 @@ def set( key, value, expiry = DEFAULT_CACHING_TIME ):
     if ACTIVE is False:
         return None
     
-    global CACHE, STATS_KEYS_COUNT
-    if key not in CACHE:
-        STATS_KEYS_COUNT += 1
+    current_timestamp = time.time()
     if expiry != None:
-        expiry = time.time() + int( expiry )
+        expiry = current_timestamp + int( expiry )
     
-    try:
-        CACHE[key] = ( value, expiry )
-    except MemoryError:
-        """ It doesn't seems to catch the exception, something in the GAE's python runtime probably """
-        logging.info( "%s memory error setting key '%s'" % ( __name__, key ) )
+    """ Size is estimated outside of the lock, it's the expensive part """
+    size = sizeof( key ) + sizeof( value )
+    groups = _classify( key )
+    shard = _shard( key )
+    with shard.lock:
+        try:
+            shard.set( key, value, expiry, size, current_timestamp, groups )
+        except MemoryError:
+            """ It doesn't seems to catch the exception, something in the GAE's python runtime probably """
+            logging.info( "%s memory error setting key '%s'" % ( __name__, key ) )
+    _enforce_budget( shard )
+
+def set_multi( mapping, expiry = DEFAULT_CACHING_TIME ):
+    """
+    Sets every key-value pair of mapping in the current instance with the same expiry, like memcache.set_multi.
+    The clock is read once and each shard is locked once for the whole batch.
+    Returns the list of keys that couldn't be set because they don't fit in the memory budget.
+    """
+    if ACTIVE is False:
+        return []
+    
+    current_timestamp = time.time()
+    if expiry != None:
+        expiry = current_timestamp + int( expiry )
+    
+    sizes = {}
+    tags = {}
+    for key, value in mapping.iteritems():
+        sizes[key] = sizeof( key ) + sizeof( value )
+        tags[key] = _classify( key )
+    not_set = []
+    shards, groups = _group( mapping )
+    for index, shard_keys in groups.iteritems():
+        shard = shards[index]
+        with shard.lock:
+            for key in shard_keys:
+                try:
+                    if not shard.set( key, mapping[key], expiry, sizes[key], current_timestamp, tags[key] ):
+                        not_set.append( key )
+                except MemoryError:
+                    logging.info( "%s memory error setting key '%s'" % ( __name__, key ) )
+                    not_set.append( key )
+    _enforce_budget()
+    return not_set
  
 def delete( key ):
     """ 
     Deletes the key stored in the cache of the current instance, not all the instances.
     There's no reason to use it except for debugging when developing, use expiry when setting a value instead.
     """
-    global CACHE, STATS_KEYS_COUNT
-    if key in CACHE:
-        STATS_KEYS_COUNT -= 1
-        del CACHE[key]
+    shard = _shard( key )
+    current_timestamp = time.time()
+    with shard.lock:
+        shard.expire( current_timestamp )
+        shard.delete( key )
+
+def delete_multi( keys ):
+    """ Deletes the given keys from the cache of the current instance, locking each shard once """
+    current_timestamp = time.time()
+    shards, groups = _group( keys )
+    for index, shard_keys in groups.iteritems():
+        shard = shards[index]
+        with shard.lock:
+            shard.expire( current_timestamp )
+            for key in shard_keys:
+                shard.delete( key )
+
+def expiries( keys ):
+    """
+    Returns a key-expiry timestamp dictionary of the given keys that are stored with an expiry and haven't
+    expired, without counting hits or moving them in least recently used order.
+    """
+    result = {}
+    if ACTIVE is False:
+        return result
+    
+    current_timestamp = time.time()
+    shards, groups = _group( keys )
+    for index, shard_keys in groups.iteritems():
+        shard = shards[index]
+        with shard.lock:
+            for key in shard_keys:
+                entry = shard.entries.get( key )
+                if entry is not None and entry[1] is not None and current_timestamp < entry[1]:
+                    result[key] = entry[1]
+    return result
+
+def sweep():
+    """ Reclaims every expired entry of the current instance now instead of a few on each operation """
+    current_timestamp = time.time()
+    for shard in SHARDS:
+        with shard.lock:
+            shard.expire( current_timestamp, _UNBOUNDED )
 
 def dump():
     """
-    Returns the cache dictionary with all the data of the current instance, not all the instances.
+    Returns a copy of the cache dictionary with all the data of the current instance, not all the instances.
     There's no reason to use it except for debugging when developing.
     """
-    global CACHE
-    return CACHE
+    result = {}
+    for shard in SHARDS:
+        with shard.lock:
+            result.update( shard.entries )
+    return result
 
 def flush():
     """
     Resets the cache of the current instance, not all the instances.
+    Shards are cleared in place so threads in the middle of an operation never see a stale cache.
     There's no reason to use it except for debugging when developing.
     """
-    global CACHE, STATS_KEYS_COUNT
-    CACHE = {}
-    STATS_KEYS_COUNT = 0
+    for shard in SHARDS:
+        with shard.lock:
+            shard.clear()
     
 def stats():
-    """ Return the hits and misses stats, the number of keys and the cache memory address of the current instance, not all the instances."""
-    global CACHE, STATS_MISSES, STATS_HITS, STATS_KEYS_COUNT
-    memory_address = "0x" + str("%X" % id( CACHE )).zfill(16)
-    return {'cache_memory_address': memory_address,
-            'hits': STATS_HITS,
-            'misses': STATS_MISSES ,
-            'keys_count': STATS_KEYS_COUNT,
-            }
-    
-def cacheit( keyformat, expiry=DEFAULT_CACHING_TIME ):
-    """ Decorator to memoize functions in the current instance cache, not all the instances. """
+    """ 
+    Return the hits, misses and evictions stats, the number of keys, their approximate size in bytes, 
+    the number of expired entries reclaimed and the bytes they freed and the cache memory address of the
+    current instance, not all the instances.
+    """
+    result = {'hits': 0, 'misses': 0, 'keys_count': 0, 'evictions': 0, 'bytes': 0,
+              'reclaimed': 0, 'reclaimed_bytes': 0}
+    for shard in SHARDS:
+        with shard.lock:
+            result['hits'] += shard.hits
+            result['misses'] += shard.misses
+            result['keys_count'] += len( shard.entries )
+            result['evictions'] += shard.evictions
+            result['bytes'] += shard.bytes
+            result['reclaimed'] += shard.reclaimed
+            result['reclaimed_bytes'] += shard.reclaimed_bytes
+    result['cache_memory_address'] = "0x" + str("%X" % id( SHARDS )).zfill(16)
+    result['shards'] = len( SHARDS )
+    result['max_bytes'] = MAX_BYTES
+    result['max_keys'] = MAX_KEYS
+    return result
+    
+def group_stats():
+    """
+    Returns a group name - stats dictionary with the hits, misses, evictions, expirations, number of keys,
+    approximate bytes and hit ratio of each group of keys, see set_classifier().
+    """
+    result = {}
+    for shard in SHARDS:
+        with shard.lock:
+            for group, stats in shard.groups.iteritems():
+                total = result.setdefault( group, dict.fromkeys( GROUP_STATS, 0 ) )
+                for stat in GROUP_STATS:
+                    total[stat] += stats[stat]
+    for stats in result.itervalues():
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float( stats['hits'] ) / lookups if lookups else None
+    return result
+
+""" 
+Snapshot file layout: SNAPSHOT_MAGIC, pickled values one after the other, a pickled index of 
+( key, expiry, offset, length ) tuples and a trailer with the index offset and SNAPSHOT_MAGIC.
+Expiry is the absolute timestamp of the entry, None means forever.
+"""
+SNAPSHOT_MAGIC = 'CACHEPY1'
+_TRAILER = struct.Struct( '!Q8s' )
+
+class _Snapshot( object ):
+    """ A snapshot file opened by load(), memory-mapped when the runtime allows it """
+    def __init__( self, path, decode ):
+        self.decode = decode
+        self.lock = threading.Lock()
+        self.file = open( path, 'rb' )
+        try:
+            import mmap
+            self.data = mmap.mmap( self.file.fileno(), 0, access = mmap.ACCESS_READ )
+        except ( ImportError, EnvironmentError, ValueError ):
+            self.data = None
+    
+    def read( self, offset, length ):
+        if self.data is not None:
+            return self.data[offset:offset + length]
+        with self.lock:
+            self.file.seek( offset )
+            return self.file.read( length )
+    
+    def size( self ):
+        self.file.seek( 0, os.SEEK_END )
+        return self.file.tell()
+
+class _Lazy( object ):
+    """ Placeholder of a loaded snapshot entry, it is decoded the first time it is read """
+    __slots__ = ( 'snapshot', 'offset', 'length' )
+    
+    def __init__( self, snapshot, offset, length ):
+        self.snapshot = snapshot
+        self.offset = offset
+        self.length = length
+    
+    def raw( self ):
+        return self.snapshot.read( self.offset, self.length )
+    
+    def value( self ):
+        value = pickle.loads( self.raw() )
+        if self.snapshot.decode is not None:
+            value = self.snapshot.decode( value )
+        return value
+
+def _materialize( key, lazy, now ):
+    """ Decodes a snapshot entry outside of the shard lock and replaces its placeholder, if nobody else did """
+    try:
+        value = lazy.value()
+    except Exception, e:
+        logging.warning( "%s could not load key '%s' from snapshot: %s" % ( __name__, key, e ) )
+        value = _MISSING
+    size = sizeof( key ) + sizeof( value )
+    shard = _shard( key )
+    with shard.lock:
+        entry = shard.entries.get( key )
+        if entry is not None and entry[0] is lazy:
+            if value is _MISSING:
+                shard.delete( key )
+            else:
+                shard.set( key, value, entry[1], size, now, shard.tags.get( key, () ) )
+    _enforce_budget( shard )
+    return value
+
+def snapshot( path, encode = None ):
+    """
+    Writes the live entries of the current instance to path, so a new instance can load() them on warmup.
+    encode is called with each value and should return something that can be pickled, entries that
+    can't be encoded are skipped. The file is written next to path and renamed when it's complete.
+    Returns the number of entries written.
+    """
+    current_timestamp = time.time()
+    entries = []
+    for shard in SHARDS:
+        with shard.lock:
+            entries.extend( ( key, value, expiry ) for key, ( value, expiry ) in shard.entries.iteritems()
+                            if expiry is None or expiry > current_timestamp )
+    
+    temp_path = path + '.tmp'
+    index = []
+    with open( temp_path, 'wb' ) as output:
+        output.write( SNAPSHOT_MAGIC )
+        offset = len( SNAPSHOT_MAGIC )
+        for key, value, expiry in entries:
+            try:
+                if isinstance( value, _Lazy ):
+                    """ Still encoded since the last load """
+                    data = value.raw()
+                else:
+                    if encode is not None:
+                        value = encode( value )
+                    data = pickle.dumps( value, pickle.HIGHEST_PROTOCOL )
+            except Exception, e:
+                logging.info( "%s skipping key '%s' in snapshot: %s" % ( __name__, key, e ) )
+                continue
+            output.write( data )
+            index.append( ( key, expiry, offset, len( data ) ) )
+            offset += len( data )
+        output.write( pickle.dumps( index, pickle.HIGHEST_PROTOCOL ) )
+        output.write( _TRAILER.pack( offset, SNAPSHOT_MAGIC ) )
+    os.rename( temp_path, path )
+    return len( index )
+
+def load( path, decode = None, lazy = True ):
+    """
+    Loads a file written by snapshot() into the cache of the current instance, skipping expired entries.
+    decode is called with each value read back. When lazy is True only the index is read and each value
+    is decoded the first time its key is read, so startup time doesn't depend on the size of the values.
+    Keys already in the cache are kept. Returns the number of entries loaded.
+    """
+    source = _Snapshot( path, decode )
+    size = source.size()
+    index_offset, magic = _TRAILER.unpack( source.read( size - _TRAILER.size, _TRAILER.size ) )
+    if magic != SNAPSHOT_MAGIC or source.read( 0, len( SNAPSHOT_MAGIC ) ) != SNAPSHOT_MAGIC:
+        raise ValueError( "%s is not a cachepy snapshot" % path )
+    index = pickle.loads( source.read( index_offset, size - _TRAILER.size - index_offset ) )
+    
+    current_timestamp = time.time()
+    loaded = 0
+    for key, expiry, offset, length in index:
+        if expiry is not None and expiry <= current_timestamp:
+            continue
+        value = _Lazy( source, offset, length )
+        if not lazy:
+            try:
+                value = value.value()
+            except Exception, e:
+                logging.warning( "%s could not load key '%s' from snapshot: %s" % ( __name__, key, e ) )
+                continue
+        groups = _classify( key )
+        shard = _shard( key )
+        with shard.lock:
+            if key in shard.entries:
+                continue
+            """ Placeholders are only charged for the bytes they reference """
+            shard.set( key, value, expiry, length if lazy else sizeof( key ) + sizeof( value ),
+                       current_timestamp, groups )
+        loaded += 1
+    _enforce_budget()
+    return loaded
+
+class _Negative( object ):
+    """ Stored by cacheit in place of a None result when negative caching is on """
+    pass
+
+NEGATIVE = _Negative()
+
+""" Seconds a cacheit caller waits for another caller computing the same key before computing it itself """
+SINGLE_FLIGHT_TIMEOUT = 30
+
+class _Flight( object ):
+    """ A computation in progress, callers missing the same key wait for its result """
+    def __init__( self ):
+        self.event = threading.Event()
+        self.done = False
+        self.result = None
+
+_FLIGHTS = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+""" Function name - stats dictionary of the cacheit decorated functions """
+CACHEIT_STATS = {}
+_CACHEIT_STATS_LOCK = threading.Lock()
+
+def _bind( argspec, args, kwargs ):
+    """ 
+    Returns the parameter values of a call in signature order and a parameter name - value dictionary,
+    so the same call made with positional or keyword arguments gets the same key.
+    Keyword arguments that aren't in the signature are returned in the dictionary only.
+    argspec is the inspect.getargspec() of the function, it is read once when it is decorated.
+    """
+    names, varargs, varkw, defaults = argspec
+    values = list( args[:len( names )] )
+    named = dict( zip( names, values ) )
+    first_default = len( names ) - len( defaults or () )
+    for index in range( len( values ), len( names ) ):
+        name = names[index]
+        if name in kwargs:
+            value = kwargs[name]
+        elif index >= first_default:
+            value = defaults[index - first_default]
+        else:
+            """ Missing argument, calling the function raises the TypeError """
+            break
+        values.append( value )
+        named[name] = value
+    values.extend( args[len( names ):] )
+    extra = {}
+    for name, value in kwargs.iteritems():
+        if name not in named:
+            named[name] = extra[name] = value
+    return values, named, extra
+
+def _cacheit_key( keyformat, argspec, args, kwargs ):
+    values, named, extra = _bind( argspec, args, kwargs )
+    if '%(' in keyformat:
+        key = keyformat % named
+    else:
+        key = keyformat % tuple( values[:keyformat.count('%')] )
+    for name in sorted( extra ):
+        key += '|%s:%s' % ( name, extra[name] )
+    return key
+
+def _count( name, stat, value = 1 ):
+    with _CACHEIT_STATS_LOCK:
+        CACHEIT_STATS[name][stat] += value
+
+def cacheit( keyformat, expiry=DEFAULT_CACHING_TIME, cache_none=False, none_expiry=DEFAULT_CACHING_TIME ):
+    """ 
+    Decorator to memoize functions in the current instance cache, not all the instances.
+    
+    keyformat is filled with the arguments of the call in signature order, or by name if it uses %(name)s
+    fields, keyword arguments that aren't in the signature are appended to the key.
+    A None result is only cached when cache_none is True, for none_expiry seconds.
+    Callers missing a key that is being computed wait for that result instead of computing it again.
+    """
     def decorator( fxn ):
+        name = '%s.%s' % ( fxn.__module__, fxn.__name__ )
+        argspec = inspect.getargspec( fxn )
+        with _CACHEIT_STATS_LOCK:
+            CACHEIT_STATS[name] = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'waits': 0,
+                                   'computes': 0, 'compute_time': 0.0}
+        
+        @functools.wraps( fxn )
         def wrapper( *args, **kwargs ):
-            key = keyformat % args[:keyformat.count('%')]
+            key = _cacheit_key( keyformat, argspec, args, kwargs )
             data = get( key )
-            if data is None:
+            if isinstance( data, _Negative ):
+                _count( name, 'negative_hits' )
+                return None
+            if data is not None:
+                _count( name, 'hits' )
+                return data
+            
+            _count( name, 'misses' )
+            with _FLIGHTS_LOCK:
+                flight = _FLIGHTS.get( key )
+                leader = flight is None
+                if leader:
+                    flight = _FLIGHTS[key] = _Flight()
+            if not leader:
+                _count( name, 'waits' )
+                flight.event.wait( SINGLE_FLIGHT_TIMEOUT )
+                if flight.done:
+                    return flight.result
+            
+            try:
+                start = time.time()
                 data = fxn( *args, **kwargs )
-                set( key, data, expiry )
-            return data
+                _count( name, 'compute_time', time.time() - start )
+                _count( name, 'computes' )
+                if data is not None:
+                    set( key, data, expiry )
+                elif cache_none:
+                    set( key, NEGATIVE, none_expiry )
+                if leader:
+                    flight.result = data
+                    flight.done = True
+                return data
+            finally:
+                if leader:
+                    with _FLIGHTS_LOCK:
+                        del _FLIGHTS[key]
+                    flight.event.set()
+        
+        wrapper.stats = lambda: cacheit_stats()[name]
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+def cacheit_stats():
+    """ Returns a copy of the hits, misses, waits and compute stats of the cacheit decorated functions """
+    with _CACHEIT_STATS_LOCK:
+        return dict( ( name, dict( stats ) ) for name, stats in CACHEIT_STATS.iteritems() )
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'PerformanceEngine'))
+import cachepy
+
+USAGE = """%%prog [BENCHMARK ...]
+Run cachepy benchmarks, cachepy has no App Engine dependencies so no SDK is needed.
+
+BENCHMARK   One of: %s (all of them by default)"""
+
+
+def _report(title, rows):
+  print title
+  for row in rows:
+    print '  ' + '  '.join(str(column).rjust(14) for column in row)
+  print
+
+
+def bench_concurrency(duration=2.0, key_count=10000):
+  '''Throughput of a 90% get / 10% set mix with a growing number of threads'''
+  rows = [('threads', 'shards', 'ops/sec', 'hit ratio')]
+  for shard_count in (1, cachepy.SHARD_COUNT):
+    cachepy.configure(shard_count=shard_count)
+    for thread_count in (1, 2, 4, 8, 16):
+      cachepy.flush()
+      for i in range(key_count):
+        cachepy.set('key_%s' % i, i)
+      before = cachepy.stats()
+      counts = [0] * thread_count
+      deadline = time.time() + duration
+
+      def worker(n):
+        rand = random.Random(n)
+        ops = 0
+        while time.time() < deadline:
+          for i in xrange(100):
+            key = 'key_%s' % rand.randint(0, key_count * 2)
+            if rand.random() < 0.9:
+              cachepy.get(key)
+            else:
+              cachepy.set(key, i)
+          ops += 100
+        counts[n] = ops
+
+      threads = [threading.Thread(target=worker, args=(n,))
+                 for n in range(thread_count)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      after = cachepy.stats()
+      hits = after['hits'] - before['hits']
+      lookups = hits + after['misses'] - before['misses']
+      rows.append((thread_count, shard_count, int(sum(counts) / duration),
+                   '%.2f' % (float(hits) / max(lookups, 1))))
+  cachepy.configure()
+  _report('Concurrent get/set throughput', rows)
+
+
+def bench_multi(sizes=(1000, 10000, 100000)):
+  '''Per key cost of single key calls against the batch calls'''
+  rows = [('keys', 'operation', 'single us/key', 'multi us/key')]
+  for size in sizes:
+    mapping = dict(('key_%s' % i, i) for i in xrange(size))
+    keys = mapping.keys()
+    timings = []
+
+    cachepy.flush()
+    start = time.time()
+    for key, value in mapping.iteritems():
+      cachepy.set(key, value, 300)
+    single = time.time() - start
+    cachepy.flush()
+    start = time.time()
+    cachepy.set_multi(mapping, 300)
+    timings.append(('set', single, time.time() - start))
+
+    start = time.time()
+    for key in keys:
+      cachepy.get(key)
+    single = time.time() - start
+    start = time.time()
+    cachepy.get_multi(keys)
+    timings.append(('get', single, time.time() - start))
+
+    start = time.time()
+    for key in keys:
+      cachepy.delete(key)
+    single = time.time() - start
+    cachepy.set_multi(mapping, 300)
+    start = time.time()
+    cachepy.delete_multi(keys)
+    timings.append(('delete', single, time.time() - start))
+
+    for operation, single, multi in timings:
+      rows.append((size, operation, '%.2f' % (single * 1e6 / size),
+                   '%.2f' % (multi * 1e6 / size)))
+  cachepy.flush()
+  _report('Single key vs batch operations', rows)
+
+
+BENCHMARKS = [('concurrency', bench_concurrency),
+              ('multi', bench_multi)]
+
+
+if __name__ == '__main__':
+  names = [name for name, _ in BENCHMARKS]
+  parser = optparse.OptionParser(USAGE % ', '.join(names))
+  options, args = parser.parse_args()
+  for name in args:
+    if name not in names:
+      print 'Error: Unknown benchmark %s' % name
+      parser.print_help()
+      sys.exit(1)
+  for name, benchmark in BENCHMARKS:
+    if not args or name in args:
+      benchmark()
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+import optparse
+import os
+import random
+import sys
+import time
+
+USAGE = """%%prog SDK_PATH [BENCHMARK ...]
+Run PerformanceEngine benchmarks against the App Engine service stubs.
+
+SDK_PATH    Path to the SDK installation
+BENCHMARK   One of: %s (all of them by default)"""
+
+
+def setup(sdk_path):
+  '''Imports App Engine and PerformanceEngine, then defines benchmark models'''
+  global db, testbed, PerformanceEngine, pdb, cachepy, BenchModel
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '..', '..'))
+  from google.appengine.ext import db
+  from google.appengine.ext import testbed
+  import PerformanceEngine
+  from PerformanceEngine import pdb, cachepy
+
+  class BenchModel(pdb.Model):
+    name = db.StringProperty()
+    count = db.IntegerProperty()
+    tags = db.StringListProperty()
+    body = db.TextProperty()
+
+
+def _activate():
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  cachepy.flush()
+  return bed
+
+
+WORDS = ('the of and to in is was for on that with as by at from his her an '
+         'which were are have been this has had not but they their one all '
+         'cache entity query memcache datastore instance request kind model '
+         'property reference expiration counter shard layer local value').split()
+
+
+def _text(size, seed=0):
+  '''Text with a word distribution closer to user content than a repeated phrase'''
+  rand = random.Random(seed)
+  words = []
+  length = 0
+  while length < size:
+    word = rand.choice(WORDS)
+    words.append(word)
+    length += len(word) + 1
+  return ' '.join(words)[:size]
+
+
+def _entities(count, body_size, prefix='bench'):
+  '''Representative entities, body_size is the length of the text property'''
+  body = _text(body_size)
+  return [BenchModel(key_name='%s_%s' % (prefix, i), name='entity %s' % i,
+                     count=i, tags=['tag_%s' % (i % 10), 'common'], body=body)
+          for i in range(count)]
+
+
+def _report(title, rows):
+  print title
+  for row in rows:
+    print '  ' + '  '.join(str(column).rjust(14) for column in row)
+  print
+
+
+def bench_local_mode(count=1000, body_sizes=(100, 2000, 20000)):
+  '''Memory per entity and read latency of the local storage modes'''
+  rows = [('body bytes', 'mode', 'bytes/entity', 'cold us/get', 'hot us/get')]
+  hot_set_size = PerformanceEngine.LOCAL_HOT_SET_SIZE
+  for body_size in body_sizes:
+    for mode in (PerformanceEngine.LOCAL_MODEL, PerformanceEngine.LOCAL_ENCODED):
+      bed = _activate()
+      PerformanceEngine.LOCAL_KIND_MODES[BenchModel.kind()] = mode
+      try:
+        models = _entities(count, body_size)
+        keys = pdb.put(models, _storage='local')
+        size = cachepy.stats()['bytes'] / count
+
+        #Cold reads decode every entity, hot reads are served from the hot set
+        PerformanceEngine.LOCAL_HOT_SET_SIZE = 0
+        start = time.time()
+        pdb.get(keys, _storage='local')
+        cold = time.time() - start
+        PerformanceEngine.LOCAL_HOT_SET_SIZE = count
+        pdb.get(keys, _storage='local')
+        start = time.time()
+        pdb.get(keys, _storage='local')
+        hot = time.time() - start
+      finally:
+        PerformanceEngine.LOCAL_HOT_SET_SIZE = hot_set_size
+        del PerformanceEngine.LOCAL_KIND_MODES[BenchModel.kind()]
+        bed.deactivate()
+      rows.append((body_size, mode, size, '%.1f' % (cold * 1e6 / count),
+                   '%.1f' % (hot * 1e6 / count)))
+  _report('Local storage modes', rows)
+
+
+def bench_compression(count=200, body_sizes=(500, 2000, 20000, 200000)):
+  '''Serialized size and CPU cost of memcache values by compression level'''
+  rows = [('body bytes', 'level', 'bytes', 'ratio', 'encode us', 'decode us')]
+  threshold = PerformanceEngine.COMPRESSION_THRESHOLD
+  level = PerformanceEngine.COMPRESSION_LEVEL
+  bed = _activate()
+  try:
+    for body_size in body_sizes:
+      models = _entities(count, body_size)
+      raw_size = None
+      for compression in (None, 1, 6, 9):
+        if compression is None:
+          PerformanceEngine.COMPRESSION_THRESHOLD = None
+        else:
+          PerformanceEngine.COMPRESSION_THRESHOLD = 0
+          PerformanceEngine.COMPRESSION_LEVEL = compression
+        start = time.time()
+        data = PerformanceEngine._serialize(models)
+        encode = time.time() - start
+        start = time.time()
+        PerformanceEngine._deserialize(data)
+        decode = time.time() - start
+        size = sum(len(value) for value in data) / count
+        if raw_size is None:
+          raw_size = size
+        rows.append((body_size, compression or 'off', size,
+                     '%.2f' % (float(size) / raw_size),
+                     '%.1f' % (encode * 1e6 / count),
+                     '%.1f' % (decode * 1e6 / count)))
+  finally:
+    PerformanceEngine.COMPRESSION_THRESHOLD = threshold
+    PerformanceEngine.COMPRESSION_LEVEL = level
+    bed.deactivate()
+  _report('Memcache value compression', rows)
+
+
+def bench_import(count=10000, body_sizes=(100, 5000)):
+  '''Throughput of a bulk import with fixed synchronous batches and _put'''
+  rows = [('body bytes', 'writer', 'entities/sec', 'batches')]
+  put_async = db.put_async
+  for body_size in body_sizes:
+    for writer in ('fixed 50', 'adaptive'):
+      bed = _activate()
+      PerformanceEngine._write_latency = PerformanceEngine._WriteLatency()
+      models = _entities(count, body_size, prefix='import')
+      batches = []
+
+      def counting_put_async(batch):
+        batches.append(len(batch))
+        return put_async(batch)
+
+      start = time.time()
+      if writer == 'adaptive':
+        db.put_async = counting_put_async
+        try:
+          PerformanceEngine._put(models)
+        finally:
+          db.put_async = put_async
+      else:
+        for i in range(0, count, 50):
+          batches.append(len(models[i:i + 50]))
+          db.put(models[i:i + 50])
+      elapsed = time.time() - start
+      bed.deactivate()
+      rows.append((body_size, writer, int(count / elapsed), len(batches)))
+  _report('Bulk import of %s entities' % count, rows)
+
+
+def bench_get_scaling(sizes=(1000, 5000, 10000, 25000, 50000)):
+  '''Per key cost of pdb.get by number of keys, flat rows mean linear scaling.
+  Datastore is left out, its stub costs more than the read path itself.'''
+  rows = [('keys', 'layers', 'us/key')]
+  bed = _activate()
+  try:
+    models = _entities(max(sizes), 100, prefix='scaling')
+    keys = [str(model.key()) for model in models]
+    for size in sizes:
+      pdb.put(models[:size], _storage=['local', 'memcache'])
+      for storage in (['local'], ['memcache'], ['local', 'memcache']):
+        if storage == ['local', 'memcache']:
+          #Memcache answers and refills local cache
+          cachepy.flush()
+        start = time.time()
+        pdb.get(keys[:size], _storage=storage, _result_type='dict')
+        elapsed = time.time() - start
+        rows.append((size, '+'.join(storage), '%.1f' % (elapsed * 1e6 / size)))
+      cachepy.flush()
+  finally:
+    bed.deactivate()
+  _report('pdb.get scaling', rows)
+
+
+def bench_keys(count=5000):
+  '''Per key cost of key normalization with the key caches off and warm'''
+  rows = [('operation', 'off us/key', 'warm us/key')]
+  size = PerformanceEngine.KEY_CACHE_SIZE
+  bed = _activate()
+  try:
+    models = _entities(count, 100, prefix='keys')
+    names = [model.key().name() for model in models]
+    keys = [str(model.key()) for model in models]
+    pdb.put(models, _storage='local')
+    operations = [
+      ('_key_str', lambda: map(PerformanceEngine._key_str, keys)),
+      ('_id_or_name', lambda: map(PerformanceEngine._id_or_name, keys)),
+      ('key paths', lambda: [PerformanceEngine._path_key_str('BenchModel', name)
+                             for name in names]),
+      ('get_by_key_name', lambda: BenchModel.get_by_key_name(
+        names, _storage='local', _result_type='name_dict'))]
+    for operation, function in operations:
+      timings = []
+      for cache_size in (None, size):
+        PerformanceEngine.KEY_CACHE_SIZE = cache_size
+        PerformanceEngine._key_strings.clear()
+        PerformanceEngine._key_names.clear()
+        function()
+        start = time.time()
+        function()
+        timings.append('%.2f' % ((time.time() - start) * 1e6 / count))
+      rows.append((operation,) + tuple(timings))
+  finally:
+    PerformanceEngine.KEY_CACHE_SIZE = size
+    bed.deactivate()
+  _report('Key normalization of %s keys' % count, rows)
+
+
+BENCHMARKS = [('local_mode', bench_local_mode),
+              ('compression', bench_compression),
+              ('import', bench_import),
+              ('get_scaling', bench_get_scaling),
+              ('keys', bench_keys)]
+
+
+if __name__ == '__main__':
+  names = [name for name, _ in BENCHMARKS]
+  parser = optparse.OptionParser(USAGE % ', '.join(names))
+  options, args = parser.parse_args()
+  if len(args) < 1:
+    print 'Error: SDK_PATH is required.'
+    parser.print_help()
+    sys.exit(1)
+  for name in args[1:]:
+    if name not in names:
+      print 'Error: Unknown benchmark %s' % name
+      parser.print_help()
+      sys.exit(1)
+  setup(args[0])
+  for name, benchmark in BENCHMARKS:
+    if len(args) == 1 or name in args[1:]:
+      benchmark()
@@ -0,0 +1,401 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from PerformanceEngine import cachepy
+
+
+class LRUTest(unittest.TestCase):
+
+  def setUp(self):
+    #A single shard makes the LRU order global
+    self.shard_count = cachepy.SHARD_COUNT
+    cachepy.configure(shard_count=1)
+
+  def tearDown(self):
+    cachepy.configure(shard_count=self.shard_count)
+    cachepy.flush()
+
+  def test_max_keys(self):
+    evictions = cachepy.stats()['evictions']
+    cachepy.configure(max_keys=3, shard_count=1)
+    for i in range(3):
+      cachepy.set('key_%s' % i, i)
+    #Touch the oldest key so key_1 becomes least recently used
+    self.assertEqual(cachepy.get('key_0'), 0)
+    cachepy.set('key_3', 3)
+
+    self.assertEqual(cachepy.get('key_1'), None)
+    self.assertEqual(cachepy.get('key_0'), 0)
+    self.assertEqual(cachepy.get('key_3'), 3)
+    self.assertEqual(cachepy.stats()['keys_count'], 3)
+    self.assertEqual(cachepy.stats()['evictions'], evictions + 1)
+
+  def test_max_bytes(self):
+    value = 'x' * 1000
+    cachepy.configure(max_bytes=cachepy.sizeof('key_0') * 5 + cachepy.sizeof(value) * 5,
+                      shard_count=1)
+    for i in range(10):
+      cachepy.set('key_%s' % i, value)
+    stats = cachepy.stats()
+    self.assertTrue(stats['bytes'] <= stats['max_bytes'])
+    self.assertEqual(stats['keys_count'], 5)
+    self.assertEqual(cachepy.get('key_0'), None)
+    self.assertEqual(cachepy.get('key_9'), value)
+
+  def test_oversized_value(self):
+    cachepy.configure(max_bytes=100, shard_count=1)
+    cachepy.set('big', 'x' * 1000)
+    self.assertEqual(cachepy.get('big'), None)
+    self.assertEqual(cachepy.stats()['keys_count'], 0)
+
+  def test_bytes_accounting(self):
+    cachepy.set('key', 'x' * 1000)
+    cachepy.set('key', 'x' * 10)
+    cachepy.delete('key')
+    self.assertEqual(cachepy.stats()['bytes'], 0)
+    self.assertEqual(cachepy.stats()['keys_count'], 0)
+
+  def test_sizeof(self):
+    self.assertTrue(cachepy.sizeof(['x' * 1000]) > 1000)
+    self.assertTrue(cachepy.sizeof({'key': 'x' * 1000}) > 1000)
+
+
+class ThreadSafetyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.shard_count = cachepy.SHARD_COUNT
+    cachepy.flush()
+
+  def tearDown(self):
+    cachepy.configure(shard_count=self.shard_count)
+    cachepy.flush()
+
+  def test_concurrent_access(self):
+    hits = cachepy.stats()['hits']
+    def worker(n):
+      for i in range(500):
+        key = 'key_%s' % (i % 50)
+        cachepy.set(key, n)
+        cachepy.get(key)
+        if i % 7 == 0:
+          cachepy.delete(key)
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    stats = cachepy.stats()
+    self.assertEqual(stats['keys_count'], len(cachepy.dump()))
+    self.assertTrue(stats['hits'] > hits)
+
+  def test_flush_in_place(self):
+    shards = cachepy.SHARDS
+    cachepy.set('key', 'value')
+    cachepy.flush()
+    self.assertTrue(shards is cachepy.SHARDS)
+    self.assertEqual(cachepy.get('key'), None)
+    self.assertEqual(cachepy.stats()['bytes'], 0)
+
+  def test_shard_count(self):
+    self.assertRaises(ValueError, cachepy.configure, shard_count=3)
+    cachepy.configure(shard_count=4)
+    self.assertEqual(cachepy.stats()['shards'], 4)
+
+
+class ExpiryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.shard_count = cachepy.SHARD_COUNT
+    cachepy.configure(shard_count=1)
+    self.time = time.time
+    self.now = self.time()
+    time.time = lambda: self.now
+
+  def tearDown(self):
+    time.time = self.time
+    cachepy.configure(shard_count=self.shard_count)
+    cachepy.flush()
+
+  def test_sweep_on_operations(self):
+    before = cachepy.stats()
+    for i in range(cachepy.SWEEP_BATCH):
+      cachepy.set('expiring_%s' % i, 'x' * 100, 10)
+    cachepy.set('forever', 'value')
+    self.now += 11
+    #Expired keys are never read again but the next operation reclaims them
+    cachepy.get('forever')
+    after = cachepy.stats()
+
+    self.assertEqual(after['keys_count'], 1)
+    self.assertEqual(after['reclaimed'] - before['reclaimed'], cachepy.SWEEP_BATCH)
+    self.assertTrue(after['reclaimed_bytes'] - before['reclaimed_bytes'] > 100 * cachepy.SWEEP_BATCH)
+
+  def test_sweep_batch_setting(self):
+    sweep_batch = cachepy.SWEEP_BATCH
+    cachepy.SWEEP_BATCH = 2
+    try:
+      for i in range(5):
+        cachepy.set('expiring_%s' % i, i, 10)
+      self.now += 11
+      cachepy.get('missing')
+    finally:
+      cachepy.SWEEP_BATCH = sweep_batch
+    self.assertEqual(cachepy.stats()['keys_count'], 3)
+
+  def test_overwritten_expiry(self):
+    cachepy.set('key', 'old', 10)
+    cachepy.set('key', 'new', 100)
+    self.now += 11
+    cachepy.sweep()
+    self.assertEqual(cachepy.get('key'), 'new')
+
+  def test_sweep(self):
+    before = cachepy.stats()['reclaimed']
+    for i in range(cachepy.SWEEP_BATCH * 3):
+      cachepy.set('key_%s' % i, i, 10)
+    self.now += 11
+    cachepy.sweep()
+    self.assertEqual(cachepy.stats()['keys_count'], 0)
+    self.assertEqual(cachepy.stats()['bytes'], 0)
+    self.assertEqual(cachepy.stats()['reclaimed'] - before, cachepy.SWEEP_BATCH * 3)
+
+
+class MultiTest(unittest.TestCase):
+
+  def setUp(self):
+    cachepy.flush()
+
+  def tearDown(self):
+    cachepy.flush()
+
+  def test_set_get_multi(self):
+    mapping = dict(('key_%s' % i, i) for i in range(100))
+    mapping['none'] = None
+    self.assertEqual(cachepy.set_multi(mapping, 60), [])
+    result = cachepy.get_multi(mapping.keys() + ['missing'])
+    self.assertEqual(result, mapping)
+    self.assertEqual(cachepy.get('key_42'), 42)
+
+  def test_delete_multi(self):
+    cachepy.set_multi({'a': 1, 'b': 2, 'c': 3})
+    cachepy.delete_multi(['a', 'b', 'missing'])
+    self.assertEqual(cachepy.get_multi(['a', 'b', 'c']), {'c': 3})
+    self.assertEqual(cachepy.stats()['keys_count'], 1)
+
+  def test_set_multi_over_budget(self):
+    cachepy.configure(max_bytes=1000)
+    try:
+      not_set = cachepy.set_multi({'small': 1, 'big': 'x' * 2000})
+    finally:
+      cachepy.configure()
+    self.assertEqual(not_set, ['big'])
+    self.assertEqual(cachepy.get_multi(['small', 'big']), {'small': 1})
+
+  def test_global_budget(self):
+    #The budget isn't split between the shards
+    cachepy.configure(max_bytes=16000)
+    try:
+      cachepy.set('big', 'x' * 2000)
+      self.assertEqual(cachepy.get('big'), 'x' * 2000)
+      cachepy.configure(max_keys=10)
+      cachepy.set_multi(dict(('key_%s' % i, i) for i in range(100)))
+      self.assertEqual(cachepy.stats()['keys_count'], 10)
+      #The last key written is kept
+      cachepy.set('last', 1)
+      self.assertEqual(cachepy.get('last'), 1)
+      self.assertEqual(cachepy.stats()['keys_count'], 10)
+    finally:
+      cachepy.configure()
+
+
+class CacheitTest(unittest.TestCase):
+
+  def setUp(self):
+    cachepy.flush()
+    self.calls = []
+
+  def tearDown(self):
+    cachepy.flush()
+
+  def test_kwargs_key(self):
+    @cachepy.cacheit('kwargs_%s_%s')
+    def add(a, b=1, **kwargs):
+      self.calls.append((a, b, kwargs))
+      return a + b + sum(kwargs.values())
+
+    self.assertEqual(add(1, 2), 3)
+    self.assertEqual(add(1, b=2), 3)
+    self.assertEqual(add(a=1, b=2), 3)
+    self.assertEqual(len(self.calls), 1)
+    self.assertEqual(add(1), 2)
+    self.assertEqual(add(1, 2, c=3), 6)
+    self.assertEqual(len(self.calls), 3)
+    self.assertEqual(add.stats()['hits'], 2)
+    self.assertEqual(add.stats()['computes'], 3)
+
+  def test_named_keyformat(self):
+    @cachepy.cacheit('named_%(b)s')
+    def second(a, b):
+      self.calls.append(b)
+      return b
+
+    second(1, 'x')
+    second(2, b='x')
+    self.assertEqual(self.calls, ['x'])
+
+  def test_negative_caching(self):
+    @cachepy.cacheit('none_%s')
+    def find(a):
+      self.calls.append(a)
+      return None
+
+    @cachepy.cacheit('negative_%s', cache_none=True, none_expiry=60)
+    def negative_find(a):
+      self.calls.append(a)
+      return None
+
+    find(1)
+    find(1)
+    self.assertEqual(len(self.calls), 2)
+    self.assertEqual(negative_find(1), None)
+    self.assertEqual(negative_find(1), None)
+    self.assertEqual(len(self.calls), 3)
+    self.assertEqual(negative_find.stats()['negative_hits'], 1)
+
+  def test_single_flight(self):
+    started = threading.Event()
+    release = threading.Event()
+
+    @cachepy.cacheit('flight_%s')
+    def slow(a):
+      self.calls.append(a)
+      started.set()
+      release.wait(5)
+      return a
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(slow(1)))
+    leader.start()
+    started.wait(5)
+    waiters = [threading.Thread(target=lambda: results.append(slow(1)))
+               for i in range(4)]
+    for thread in waiters:
+      thread.start()
+    while slow.stats()['waits'] < 4:
+      time.sleep(0.01)
+    release.set()
+    for thread in [leader] + waiters:
+      thread.join()
+
+    self.assertEqual(results, [1] * 5)
+    self.assertEqual(self.calls, [1])
+
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    cachepy.flush()
+    handle, self.path = tempfile.mkstemp()
+    os.close(handle)
+    self.time = time.time
+    self.now = self.time()
+    time.time = lambda: self.now
+
+  def tearDown(self):
+    time.time = self.time
+    os.remove(self.path)
+    cachepy.flush()
+
+  def test_snapshot_load(self):
+    cachepy.set('forever', {'a': 1})
+    cachepy.set('short', 'short', 10)
+    cachepy.set('long', ['long'], 100)
+    self.assertEqual(cachepy.snapshot(self.path), 3)
+    cachepy.flush()
+    self.now += 50
+
+    self.assertEqual(cachepy.load(self.path), 2)
+    self.assertEqual(cachepy.get_multi(['forever', 'short', 'long']),
+                     {'forever': {'a': 1}, 'long': ['long']})
+    #Remaining time to live is kept
+    self.now += 51
+    self.assertEqual(cachepy.get('long'), None)
+
+  def test_encode_decode(self):
+    cachepy.set('key', 'value')
+    cachepy.snapshot(self.path, encode=lambda value: ('encoded', value))
+    cachepy.flush()
+    cachepy.load(self.path, decode=lambda data: data[1].upper(), lazy=False)
+    self.assertEqual(cachepy.dump()['key'][0], 'VALUE')
+
+  def test_lazy_resnapshot(self):
+    cachepy.set('key', 'value')
+    cachepy.snapshot(self.path)
+    cachepy.flush()
+    cachepy.load(self.path)
+    #Entries that were never read are copied without decoding them
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+      cachepy.snapshot(path)
+      cachepy.flush()
+      cachepy.load(path)
+      self.assertEqual(cachepy.get('key'), 'value')
+    finally:
+      os.remove(path)
+
+  def test_keep_existing(self):
+    cachepy.set('key', 'old')
+    cachepy.snapshot(self.path)
+    cachepy.set('key', 'new')
+    self.assertEqual(cachepy.load(self.path), 0)
+    self.assertEqual(cachepy.get('key'), 'new')
+
+
+class GroupStatsTest(unittest.TestCase):
+
+  def setUp(self):
+    cachepy.flush()
+    self.classifier = cachepy.CLASSIFIER
+    cachepy.set_classifier(lambda key: ['prefix:' + key.split('_')[0]])
+
+  def tearDown(self):
+    cachepy.set_classifier(self.classifier)
+    cachepy.flush()
+
+  def test_group_stats(self):
+    cachepy.set_multi({'a_1': 1, 'a_2': 2, 'b_1': 'x' * 100})
+    cachepy.get_multi(['a_1', 'a_2', 'a_3', 'b_1'])
+    cachepy.delete('a_2')
+    stats = cachepy.group_stats()
+
+    self.assertEqual(stats['prefix:a']['hits'], 2)
+    self.assertEqual(stats['prefix:a']['misses'], 1)
+    self.assertEqual(stats['prefix:a']['keys'], 1)
+    self.assertAlmostEqual(stats['prefix:a']['hit_ratio'], 2 / 3.0)
+    self.assertTrue(stats['prefix:b']['bytes'] > stats['prefix:a']['bytes'])
+
+  def test_classified_outside_lock(self):
+    calls = []
+    def classifier(key):
+      calls.append(cachepy._shard(key).lock.locked())
+      return ['all']
+    cachepy.set_classifier(classifier)
+    cachepy.set('a_1', 1)
+    for i in range(3):
+      cachepy.get('a_1')
+    cachepy.get('missing')
+    #Hits use the groups tagged when the key was set
+    self.assertEqual(calls, [False, False])
+    self.assertEqual(cachepy.group_stats()['all']['hits'], 3)
+    self.assertEqual(cachepy.group_stats()['all']['misses'], 1)
+
+  def test_regroup(self):
+    cachepy.set('a_1', 1)
+    cachepy.set_classifier(lambda key: ['all'])
+    stats = cachepy.group_stats()
+    self.assertEqual(stats['all']['keys'], 1)
+    self.assertEqual(stats['all']['bytes'], cachepy.stats()['bytes'])
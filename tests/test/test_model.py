@@ -2,7 +2,9 @@ import unittest
 import logging
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 from google.appengine.ext import testbed
+import PerformanceEngine
 from PerformanceEngine import pdb
 from models import PdbModel
 
@@ -77,6 +79,16 @@ class ModelTest(unittest.TestCase):
     self.assertEqual(memcache_entity.name,self.setup_name)
     self.assertEqual(db_entity.name,self.setup_name)
     
+  def test_get_by_key_name_namespace(self):
+    pdb.put(PdbModel(key_name='root_model',name=self.setup_name))
+    self.assertEqual(PdbModel.get_by_key_name('root_model').name,self.setup_name)
+    #Cached key paths are separated by namespace
+    namespace_manager.set_namespace('other')
+    try:
+      self.assertEqual(PdbModel.get_by_key_name('root_model'),None)
+    finally:
+      namespace_manager.set_namespace('')
+    
   def test_get_by_id(self):
     local_entity = PdbModel.get_by_id(self.setup_key_int.id(),
                                       parent = self.parent_key,
@@ -142,6 +154,36 @@ class ModelTest(unittest.TestCase):
     self.assertEqual(memcache_entity.name,self.setup_name)
     self.assertEqual(db_entity.name,self.setup_name)
   
+  def test_prefetch_refs(self):
+    class AuthorModel(pdb.Model):
+      company = db.ReferenceProperty(PdbModel)
+    class CommentModel(pdb.Model):
+      author = db.ReferenceProperty(AuthorModel)
+      
+    authors = [AuthorModel(key_name='author_%s' % i,company=self.parent_key) for i in range(2)]
+    pdb.put(authors)
+    comments = [CommentModel(author=authors[i % 2].key()) for i in range(10)]
+    pdb.put(comments)
+    comments = pdb.get([comment.key() for comment in comments])+[None]
+    
+    lookups = []
+    async_get = PerformanceEngine._AsyncGet
+    class CountingGet(async_get):
+      def __init__(self,keys,*args):
+        lookups.append(len(keys))
+        async_get.__init__(self,keys,*args)
+    PerformanceEngine._AsyncGet = CountingGet
+    try:
+      self.assertTrue(pdb.prefetch_refs(comments,'author','author.company') is comments)
+      #One lookup per reference level with de-duplicated keys
+      self.assertEqual(lookups,[2,1])
+      self.assertTrue(comments[0].cached_ref('author') is comments[2].author)
+      self.assertEqual(comments[1].author.company.key(),self.parent_key)
+      self.assertEqual(lookups,[2,1])
+    finally:
+      PerformanceEngine._AsyncGet = async_get
+    self.assertRaises(PerformanceEngine.ReferenceError,pdb.prefetch_refs,comments,'missing')
+    
   def test_cached_set(self):
     class RefModel(pdb.Model):
       reference = db.ReferenceProperty(PdbModel)
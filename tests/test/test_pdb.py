@@ -1,10 +1,19 @@
+import base64
+import os
+import tempfile
+import threading
+import time
 import unittest
 import logging
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 from google.appengine.ext import testbed
+from google.appengine.runtime import apiproxy_errors
+import PerformanceEngine
 from PerformanceEngine import pdb,_serialize,_deserialize,cachepy
-from models import TestModel
+from models import TestModel,PdbModel
+from datetime import datetime
 
 
 class GetTest(unittest.TestCase):
@@ -77,6 +86,48 @@ class GetTest(unittest.TestCase):
     self.assertEqual(name_dict_result.keys()[0],str(k1.id()))
     self.assertEqual(name_dict_result.values()[0].name,'integer_test')    
         
+  def test_get_async(self):
+    e1 = TestModel(key_name='async_model',name='async')
+    k1 = db.put(e1)
+    rpc = pdb.get_async([self.setup_key,k1],_storage=['local','memcache','datastore'])
+    models = rpc.get_result()
+    self.assertEqual([model.name for model in models],['test','async'])
+    self.assertTrue(rpc.get_result() is models)
+    
+    #Refills are visible to the next call
+    self.assertEqual(pdb.get(k1,_storage='memcache').name,'async')
+    self.assertEqual(pdb.get(k1,_storage='local').name,'async')
+    
+  def test_sources(self):
+    e1 = TestModel(key_name='source_model')
+    k1 = db.put(e1)
+    keys = [self.setup_key,k1,self.setup_key,db.Key.from_path(TestModel.kind(),'missing')]
+    rpc = pdb.get_async(keys,_storage=['local','memcache','datastore'])
+    self.assertEqual(len(rpc.get_result()),4)
+    self.assertEqual(rpc.sources,{str(self.setup_key):'local',str(k1):'datastore'})
+    
+  def test_get_layer(self):
+    class DictLayer(PerformanceEngine.GetLayer):
+      synchronous = True
+      def __init__(self,values):
+        self.values = values
+      def get_async(self,keys,get):
+        return PerformanceEngine._Done(dict((key,self.values[key]) for key in keys 
+                                            if key in self.values))
+    model = TestModel(key_name='layer_model',name='layer')
+    PerformanceEngine.GET_LAYERS['dict'] = DictLayer({str(model.key()):model})
+    try:
+      rpc = pdb.get_async(model.key(),_storage=['memcache','dict'])
+      self.assertTrue(rpc.get_result() is model)
+      self.assertEqual(rpc.sources,{str(model.key()):'dict'})
+    finally:
+      del PerformanceEngine.GET_LAYERS['dict']
+    #Layers above the one that answered are refilled
+    self.assertEqual(pdb.get(model.key(),_storage='memcache').name,'layer')
+    self.assertRaises(PerformanceEngine.StorageLayerError,pdb.get,model.key(),_storage='dict')
+    #get_async is required
+    self.assertRaises(TypeError,PerformanceEngine.GetLayer)
+        
 class PutTest(unittest.TestCase):
   
   def setUp(self):
@@ -105,6 +156,772 @@ class PutTest(unittest.TestCase):
     entity = cachepy.get(str(key))
     self.assertEqual('test', entity.name)
     
+  def test_put_async(self):
+    rpc = pdb.put_async([TestModel(name='async_%s' % i) for i in range(3)],
+                        _storage=['local','memcache','datastore'])
+    keys = rpc.get_result()
+    self.assertEqual(len(keys),3)
+    self.assertEqual(pdb.get(keys[0],_storage='memcache').name,'async_0')
+    self.assertEqual(pdb.get(keys[1],_storage='local').name,'async_1')
+    self.assertEqual(db.get(keys[2]).name,'async_2')
+    
+    pdb.delete_async(keys).get_result()
+    self.assertEqual(pdb.get(keys,_storage=['local','memcache','datastore']),[None]*3)
+    
+  def test_put_memcache_chunked(self):
+    chunk_size = PerformanceEngine.MEMCACHE_CHUNK_SIZE
+    PerformanceEngine.MEMCACHE_CHUNK_SIZE = 20
+    try:
+      model = TestModel(key_name='test_key_name',name='chunked'*10)
+      key = pdb.put(model,_storage='memcache')
+      self.assertTrue(PerformanceEngine._is_manifest(memcache.get(str(key))))
+      self.assertEqual(pdb.get(key,_storage='memcache').name,model.name)
+      
+      #A missing chunk turns the whole value into a miss
+      marker,version,count,checksum,pickled = memcache.get(str(key))
+      memcache.delete(PerformanceEngine._chunk_key(str(key),version,count-1))
+      self.assertEqual(pdb.get(key,_storage='memcache'),None)
+    finally:
+      PerformanceEngine.MEMCACHE_CHUNK_SIZE = chunk_size
+    
+  def test_put_local_encoded(self):
+    PerformanceEngine.LOCAL_KIND_MODES[TestModel.kind()] = PerformanceEngine.LOCAL_ENCODED
+    try:
+      model = TestModel(key_name='test_key_name',name='encoded')
+      key = pdb.put(model,_storage='local')
+      self.assertTrue(isinstance(cachepy.get(str(key)), str))
+      
+      entity = pdb.get(key,_storage='local')
+      self.assertEqual('encoded', entity.name)
+      self.assertFalse(entity is model)
+      #Each caller gets its own model
+      entity.name = 'changed'
+      db.put(entity)
+      self.assertFalse(pdb.get(key,_storage='local') is entity)
+      self.assertEqual('encoded', pdb.get(key,_storage='local').name)
+      pdb.put(TestModel(key_name='test_key_name',name='updated'),_storage='local')
+      self.assertEqual('updated', pdb.get(key,_storage='local').name)
+    finally:
+      del PerformanceEngine.LOCAL_KIND_MODES[TestModel.kind()]
+    
+class PutBatchTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    self.latency = PerformanceEngine._write_latency
+    PerformanceEngine._write_latency = PerformanceEngine._WriteLatency()
+    self.put_async = db.put_async
+    self.batches = []
+    self.read_only = False
+    
+  def tearDown(self):
+    db.put_async = self.put_async
+    PerformanceEngine._write_latency = self.latency
+    self.testbed.deactivate()
+  
+  def _put_async(self,models):
+    self.batches.append([model.key().name() for model in models])
+    if 'timeout_5' in self.batches[-1]:
+      return self
+    return self.put_async(models)
+  
+  def get_result(self):
+    if self.read_only:
+      raise apiproxy_errors.CapabilityDisabledError()
+    raise apiproxy_errors.DeadlineExceededError()
+    
+  def test_batch_bytes(self):
+    db.put_async = self._put_async
+    bytes = PerformanceEngine.PUT_BATCH_BYTES
+    PerformanceEngine.PUT_BATCH_BYTES = 1000
+    try:
+      models = [TestModel(key_name='bytes_%s' % i,name='x'*400) for i in range(10)]
+      self.assertEqual(len(PerformanceEngine._put(models)),10)
+    finally:
+      PerformanceEngine.PUT_BATCH_BYTES = bytes
+    self.assertEqual([len(batch) for batch in self.batches],[2]*5)
+    
+  def test_deadline(self):
+    db.put_async = self._put_async
+    models = [TestModel(key_name='timeout_%s' % i) for i in range(120)]
+    keys = PerformanceEngine._PutRPC(models).get_result()
+    failed = [batch for batch in self.batches if 'timeout_5' in batch][0]
+    self.assertEqual(len(keys),120-len(failed))
+    self.assertEqual(db.get(db.Key.from_path(TestModel.kind(),'timeout_5')),None)
+    tasks = self.taskqueue.GetTasks('default')
+    self.assertEqual(len(tasks),1)
+    
+    #The task refers to a stored chunk instead of carrying the models
+    self.assertEqual(PerformanceEngine._RetryChunk.all().count(),1)
+    db.put_async = self.put_async
+    before = pdb.stats()
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertEqual(db.get(db.Key.from_path(TestModel.kind(),'timeout_5')).key().name(),'timeout_5')
+    self.assertEqual(pdb.stats()['retry_written']-before['retry_written'],len(failed))
+    self.assertEqual(PerformanceEngine._RetryChunk.all().count(),0)
+    
+  def test_retry_superseded(self):
+    db.put_async = self._put_async
+    PerformanceEngine._PutRPC([TestModel(key_name='timeout_5',name='old')]).get_result()
+    db.put_async = self.put_async
+    pdb.put(TestModel(key_name='timeout_5',name='new'))
+    before = pdb.stats()
+    tasks = self.taskqueue.GetTasks('default')
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertEqual(pdb.stats()['retry_superseded']-before['retry_superseded'],1)
+    self.assertEqual(db.get(db.Key.from_path(TestModel.kind(),'timeout_5')).name,'new')
+    
+  def test_retry_superseded_datastore(self):
+    db.put_async = self._put_async
+    PerformanceEngine._PutRPC([TestModel(key_name='timeout_5',name='old')]).get_result()
+    db.put_async = self.put_async
+    pdb.put(TestModel(key_name='timeout_5',name='new'),_storage='datastore')
+    tasks = self.taskqueue.GetTasks('default')
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertEqual(db.get(db.Key.from_path(TestModel.kind(),'timeout_5')).name,'new')
+    
+  def test_retry_markers(self):
+    #Puts without pending retries don't add markers
+    pdb.put(TestModel(key_name='no_retry'))
+    self.assertEqual(memcache.get_stats()['items'],1)
+    
+    #A retry that fails again keeps the marker of its new chunk
+    db.put_async = self._put_async
+    PerformanceEngine._PutRPC([TestModel(key_name='timeout_5')]).get_result()
+    marker = PerformanceEngine._retry_key(str(db.Key.from_path(TestModel.kind(),'timeout_5')))
+    first = memcache.get(marker)
+    tasks = self.taskqueue.GetTasks('default')
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertTrue(memcache.get(marker) not in (None,'',first))
+    self.assertEqual(len(self.taskqueue.GetTasks('default')),2)
+    
+  def test_read_only(self):
+    self.read_only = True
+    db.put_async = self._put_async
+    key = db.Key.from_path(TestModel.kind(),'timeout_5')
+    PerformanceEngine._PutRPC([TestModel(key_name='timeout_5')]).get_result()
+    db.put_async = self.put_async
+    #The models travel in the task, a memcache eviction doesn't lose them
+    memcache.flush_all()
+    tasks = self.taskqueue.GetTasks('default')
+    self.assertEqual(len(tasks),1)
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertTrue(db.get(key) is not None)
+    
+class WriteBehindTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    self.window = PerformanceEngine.WRITE_BEHIND_WINDOW
+    PerformanceEngine.WRITE_BEHIND_WINDOW = 10**6
+    PerformanceEngine._scheduled_windows.clear()
+    
+  def tearDown(self):
+    PerformanceEngine.WRITE_BEHIND_WINDOW = self.window
+    self.testbed.deactivate()
+    
+  def test_write_behind(self):
+    before = pdb.stats()
+    key = pdb.put(TestModel(key_name='behind',name='first'),_write_behind=True)
+    pdb.put(TestModel(key_name='behind',name='second'),_write_behind=True)
+    self.assertEqual(db.get(key),None)
+    self.assertEqual(pdb.get(key,_storage='memcache').name,'second')
+    
+    #Both puts are coalesced into one datastore write by the window flush
+    tasks = self.taskqueue.GetTasks('default')
+    self.assertEqual(len(tasks),1)
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertEqual(db.get(key).name,'second')
+    stats = pdb.stats()
+    self.assertEqual(stats['write_behind_puts']-before['write_behind_puts'],2)
+    self.assertEqual(stats['write_behind_writes']-before['write_behind_writes'],1)
+    
+    #A window is flushed once
+    self.assertEqual(pdb.flush_write_behind(),0)
+    
+  def test_write_behind_default(self):
+    PerformanceEngine.WRITE_BEHIND = True
+    try:
+      key = pdb.put(TestModel(key_name='behind_default'))
+    finally:
+      PerformanceEngine.WRITE_BEHIND = False
+    self.assertEqual(db.get(key),None)
+    self.assertEqual(len(self.taskqueue.GetTasks('default')),1)
+    
+  def test_write_behind_failed_flush(self):
+    key = pdb.put(TestModel(key_name='behind_failed'),_write_behind=True)
+    body = base64.b64decode(self.taskqueue.GetTasks('default')[0]['body'])
+    put = PerformanceEngine._put
+    def failing_put(models):
+      raise db.Timeout()
+    PerformanceEngine._put = failing_put
+    try:
+      self.assertRaises(db.Timeout,deferred.run,body)
+    finally:
+      PerformanceEngine._put = put
+    #The task retry writes the window
+    deferred.run(body)
+    self.assertTrue(db.get(key) is not None)
+    
+  def test_write_behind_flushed_window(self):
+    PerformanceEngine.WRITE_BEHIND_WINDOW = 10
+    now = time.time
+    clock = [(int(now())//10)*10+9.5]
+    time.time = lambda: clock[0]
+    try:
+      first = pdb.put(TestModel(key_name='behind_first'),_write_behind=True)
+      #Windows are flushed after the grace period
+      clock[0] += 1
+      self.assertEqual(pdb.flush_write_behind(),0)
+      clock[0] += PerformanceEngine.WRITE_BEHIND_GRACE
+      self.assertEqual(pdb.flush_write_behind(),1)
+      #A writer that picked the window before it was flushed writes to datastore
+      clock[0] -= PerformanceEngine.WRITE_BEHIND_GRACE+1
+      second = pdb.put(TestModel(key_name='behind_second'),_write_behind=True)
+    finally:
+      time.time = now
+    self.assertTrue(db.get(first) is not None)
+    self.assertTrue(db.get(second) is not None)
+    
+  def test_write_behind_without_key(self):
+    self.assertRaises(PerformanceEngine.IdentifierNotFoundError,pdb.put,
+                      TestModel(name='no key'),_write_behind=True)
+    
+class BatchTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    self.put_async = db.put_async
+    self.batches = []
+    
+  def tearDown(self):
+    db.put_async = self.put_async
+    self.testbed.deactivate()
+    
+  def _put_async(self,models):
+    self.batches.append(len(models) if isinstance(models,list) else 1)
+    return self.put_async(models)
+  
+  def test_batch(self):
+    deleted = db.put(TestModel(key_name='batch_deleted'))
+    db.put_async = self._put_async
+    with pdb.batch():
+      for i in range(10):
+        PdbModel(key_name='batch_%s' % i,name='first').put()
+      key = PdbModel(key_name='batch_0',name='last').put()
+      pdb.delete(deleted)
+      with pdb.batch():
+        pdb.put(TestModel(key_name='batch_nested'))
+      self.assertEqual(self.batches,[])
+      self.assertEqual(db.get(key),None)
+      #Reads see buffered writes
+      self.assertEqual(pdb.get(key).name,'last')
+      self.assertEqual(pdb.get(deleted),None)
+      
+      #Datastore assigns keys of models without key names right away
+      pdb.put(TestModel(name='no key'))
+      self.assertEqual(self.batches,[1])
+    self.assertEqual(self.batches,[1,11])
+    self.assertEqual(db.get(key).name,'last')
+    self.assertEqual(pdb.get(key,_storage='memcache').name,'last')
+    self.assertEqual(db.get(deleted),None)
+    
+  def test_middleware(self):
+    def app(environ,start_response):
+      pdb.put(TestModel(key_name='middleware'))
+      self.assertEqual(db.get(db.Key.from_path(TestModel.kind(),'middleware')),None)
+      return ['ok']
+    self.assertEqual(PerformanceEngine.BatchMiddleware(app)({},None),['ok'])
+    self.assertTrue(db.get(db.Key.from_path(TestModel.kind(),'middleware')) is not None)
+    
+class SkipUnchangedTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    self.put_async = db.put_async
+    self.batches = []
+    
+  def tearDown(self):
+    db.put_async = self.put_async
+    self.testbed.deactivate()
+    
+  def _put_async(self,models):
+    self.batches.append(len(models) if isinstance(models,list) else 1)
+    return self.put_async(models)
+    
+  def test_skip_unchanged(self):
+    PerformanceEngine.SKIP_UNCHANGED = True
+    try:
+      key = pdb.put(PdbModel(key_name='unchanged',name='first'),_skip_unchanged=True)
+      db.put_async = self._put_async
+      before = pdb.stats()
+      model = pdb.get(key,_storage='datastore')
+      self.assertEqual(pdb.put(model,_skip_unchanged=True),key)
+      self.assertEqual(self.batches,[])
+      self.assertEqual(pdb.stats()['skipped_writes']-before['skipped_writes'],1)
+      
+      #Models decoded from memcache are fingerprinted from their protobuf,
+      #SKIP_UNCHANGED turns skipping on without _skip_unchanged
+      self.assertEqual(pdb.put(pdb.get(key,_storage='memcache')),key)
+      self.assertEqual(self.batches,[])
+      
+      model.name = 'second'
+      self.assertEqual(pdb.put([model,PdbModel(key_name='new')],_skip_unchanged=True)[0],key)
+      self.assertEqual(self.batches,[2])
+      self.assertEqual(pdb.put(model,_skip_unchanged=False),key)
+      self.assertEqual(self.batches,[2,1])
+      
+      #Deletes invalidate fingerprints of their kind
+      model = pdb.get(key)
+      pdb.delete(key)
+      pdb.put(model,_skip_unchanged=True)
+      self.assertTrue(db.get(key) is not None)
+    finally:
+      PerformanceEngine.SKIP_UNCHANGED = False
+    
+  def test_delete_key_parameter(self):
+    self.assertRaises(PerformanceEngine.KeyParameterError,pdb.delete,123)
+    
+class RequestScopeTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.key = pdb.put(TestModel(key_name='scoped',name='first'))
+    
+  def tearDown(self):
+    self.testbed.deactivate()
+    
+  def test_request_scope(self):
+    with pdb.request_scope():
+      model = pdb.get(self.key)
+      memcache.flush_all()
+      before = pdb.stats()
+      self.assertTrue(pdb.get(self.key) is model)
+      self.assertEqual(pdb.stats()['scope_hits']-before['scope_hits'],1)
+      
+      #Puts replace and deletes remove mapped models
+      replaced = TestModel(key_name='scoped',name='second')
+      pdb.put(replaced,_storage='memcache')
+      self.assertTrue(pdb.get(self.key,_storage='datastore') is replaced)
+      pdb.delete(self.key)
+      self.assertEqual(pdb.get(self.key),None)
+    pdb.put(model)
+    self.assertFalse(pdb.get(self.key) is model)
+    
+  def test_middleware(self):
+    def app(environ,start_response):
+      self.assertTrue(pdb.get(self.key) is pdb.get(self.key))
+      return ['ok']
+    self.assertEqual(PerformanceEngine.RequestScopeMiddleware(app)({},None),['ok'])
+    self.assertEqual(PerformanceEngine._scope.models,{})
+    
+class CounterTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    self.buffer_time = PerformanceEngine.COUNTER_BUFFER_TIME
+    PerformanceEngine.COUNTER_BUFFER_TIME = 10**6
+    PerformanceEngine._scheduled_folds.clear()
+    
+  def tearDown(self):
+    PerformanceEngine._counter_buffer.clear()
+    PerformanceEngine.COUNTER_BUFFER_TIME = self.buffer_time
+    self.testbed.deactivate()
+    
+  def test_counter(self):
+    counter = pdb.Counter('views',shards=5)
+    for i in range(10):
+      counter.incr()
+    counter.incr(-3)
+    self.assertEqual(counter.value(),7)
+    self.assertEqual(len(self.taskqueue.GetTasks('default')),0)
+    
+    #Buffered increments are sent to memcache in one call
+    pdb.wait_all()
+    self.assertEqual(counter.value(),7)
+    tasks = self.taskqueue.GetTasks('default')
+    self.assertEqual(len(tasks),1)
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertEqual(PerformanceEngine._CounterShard.all().count(),1)
+    self.assertEqual(counter.value(),7)
+    memcache.flush_all()
+    self.assertEqual(counter.value(),7)
+    
+  def test_counter_stale_buffer(self):
+    counter = pdb.Counter('stale',shards=5)
+    counter.incr(3)
+    delta_key = PerformanceEngine._counter_key('stale','delta')
+    self.assertEqual(memcache.get(delta_key),None)
+    #After a quiet period the next pdb call sends the buffer
+    PerformanceEngine.COUNTER_BUFFER_TIME = 0
+    pdb.get(db.Key.from_path(TestModel.kind(),'missing'))
+    self.assertEqual(int(memcache.get(delta_key))-PerformanceEngine._COUNTER_BIAS,3)
+    
+  def test_counter_period(self):
+    counter = pdb.Counter('hits',period='hour')
+    counter.incr(2)
+    self.assertEqual(counter.value(at=datetime(2011,1,1,15,10)),0)
+    self.assertEqual(counter.value(),2)
+    self.assertNotEqual(counter._bucket(datetime(2011,1,1,15,10)),
+                        counter._bucket(datetime(2011,1,1,16,10)))
+    self.assertEqual(counter._bucket(datetime(2011,1,1,15,10)),
+                     counter._bucket(datetime(2011,1,1,15,50)))
+    self.assertRaises(PerformanceEngine.CounterPeriodError,pdb.Counter,'hits',period='week')
+    
+class TombstoneTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    
+  def tearDown(self):
+    self.testbed.deactivate()
+    
+  def test_tombstone(self):
+    key = db.Key.from_path(TestModel.kind(),'tombstone')
+    storage = ['local','memcache','datastore']
+    before = pdb.stats()
+    PerformanceEngine.TOMBSTONE_EXPIRATION = 60
+    try:
+      self.assertEqual(pdb.get(key,_storage=storage),None)
+    finally:
+      PerformanceEngine.TOMBSTONE_EXPIRATION = None
+    pdb.wait_all()
+    self.assertEqual(cachepy.get(str(key)),PerformanceEngine._TOMBSTONE)
+    self.assertEqual(memcache.get(str(key)),PerformanceEngine._TOMBSTONE)
+    
+    #Tombstones answer without reading datastore
+    db.put(TestModel(key_name='tombstone',name='raw'))
+    self.assertEqual(pdb.get(key,_storage=storage,_tombstone_expiration=60),None)
+    cachepy.delete(str(key))
+    self.assertEqual(pdb.get(key,_storage=storage,_tombstone_expiration=60),None)
+    stats = pdb.stats()
+    self.assertEqual(stats['local_tombstone_hits']-before['local_tombstone_hits'],1)
+    self.assertEqual(stats['memcache_tombstone_hits']-before['memcache_tombstone_hits'],1)
+    
+    #pdb.put clears tombstones of layers it doesn't write
+    pdb.put(TestModel(key_name='tombstone',name='put'),_storage='datastore')
+    self.assertEqual(pdb.get(key,_storage=storage).name,'put')
+    
+  def test_tombstone_off(self):
+    key = db.Key.from_path(TestModel.kind(),'no_tombstone')
+    pdb.get(key,_storage=['local','datastore'],_tombstone_expiration=None)
+    self.assertEqual(cachepy.get(str(key)),None)
+    pdb.get(key,_storage=['local','datastore'],_tombstone_expiration=False)
+    self.assertEqual(cachepy.get(str(key)),None)
+    #Tombstones are off by default, db.put writes are seen right away
+    self.assertEqual(pdb.get(key),None)
+    db.put(TestModel(key_name='no_tombstone',name='raw'))
+    self.assertEqual(pdb.get(key).name,'raw')
+    
+  def test_tombstone_forever(self):
+    key = db.Key.from_path(TestModel.kind(),'tombstone_forever')
+    pdb.get(key,_storage=['local','memcache','datastore'],_tombstone_expiration=0)
+    pdb.wait_all()
+    self.assertEqual(cachepy.get(str(key)),PerformanceEngine._TOMBSTONE)
+    self.assertEqual(memcache.get(str(key)),PerformanceEngine._TOMBSTONE)
+    
+class LeaseTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.lease_wait = PerformanceEngine.LEASE_WAIT
+    PerformanceEngine.LEASE_WAIT = 0.2
+    self.key = db.put(TestModel(key_name='lease',name='lease'))
+    
+  def tearDown(self):
+    PerformanceEngine.LEASE_WAIT = self.lease_wait
+    self.testbed.deactivate()
+    
+  def test_lease_granted(self):
+    before = pdb.stats()
+    self.assertEqual(pdb.get(self.key).name,'lease')
+    pdb.wait_all()
+    self.assertEqual(pdb.stats()['leases_granted']-before['leases_granted'],1)
+    self.assertEqual(memcache.get(PerformanceEngine._lease_key(str(self.key))),None)
+    self.assertTrue(memcache.get(str(self.key)) is not None)
+    
+  def test_lease_waited(self):
+    before = pdb.stats()
+    memcache.add(PerformanceEngine._lease_key(str(self.key)),1)
+    holder = threading.Timer(0.05,memcache.set,
+                             (str(self.key),_serialize(TestModel(key_name='lease',name='holder'))))
+    holder.start()
+    self.assertEqual(pdb.get(self.key).name,'holder')
+    holder.join()
+    self.assertEqual(pdb.stats()['leases_waited']-before['leases_waited'],1)
+    
+  def test_lease_timeout(self):
+    before = pdb.stats()
+    memcache.add(PerformanceEngine._lease_key(str(self.key)),1)
+    self.assertEqual(pdb.get(self.key).name,'lease')
+    pdb.wait_all()
+    self.assertEqual(pdb.stats()['lease_timeouts']-before['lease_timeouts'],1)
+    #Only the lease holder refills memcache
+    self.assertEqual(memcache.get(str(self.key)),None)
+    
+class RefreshAheadTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    cachepy.flush()
+    
+  def tearDown(self):
+    self.testbed.deactivate()
+    
+  def test_refresh_local(self):
+    key = pdb.put(TestModel(key_name='refresh_local',name='old'),
+                  _storage=['local','datastore'],_local_expiration=100)
+    db.put(TestModel(key_name='refresh_local',name='new'))
+    storage = ['local','datastore']
+    self.assertEqual(pdb.get(key,_storage=storage,_refresh_ahead=10).name,'old')
+    self.assertEqual(pdb.get(key,_storage=storage,_refresh_ahead=200).name,'old')
+    pdb.wait_all()
+    self.assertEqual(pdb.get(key,_storage='local').name,'new')
+    
+  def test_refresh_middleware(self):
+    key = pdb.put(TestModel(key_name='refresh_middleware',name='old'),
+                  _storage=['local','datastore'],_local_expiration=100)
+    db.put(TestModel(key_name='refresh_middleware',name='new'))
+    def app(environ,start_response):
+      pdb.get(key,_storage=['local','datastore'],_refresh_ahead=200)
+      return ['ok']
+    self.assertEqual(PerformanceEngine.RequestScopeMiddleware(app)({},None),['ok'])
+    self.assertEqual(pdb.get(key,_storage='local').name,'new')
+    
+  def test_refresh_queue_size(self):
+    size = PerformanceEngine.REFRESH_QUEUE_SIZE
+    PerformanceEngine.REFRESH_QUEUE_SIZE = 2
+    try:
+      for i in range(5):
+        PerformanceEngine._refresh_later('key_%s' % i,None,())
+      self.assertEqual(len(PerformanceEngine._pending.refreshes),2)
+    finally:
+      PerformanceEngine.REFRESH_QUEUE_SIZE = size
+      PerformanceEngine._pending.refreshes.clear()
+    
+  def test_refresh_memcache(self):
+    key = pdb.put(TestModel(key_name='refresh_memcache',name='old'),
+                  _memcache_expiration=100)
+    db.put(TestModel(key_name='refresh_memcache',name='new'))
+    self.assertEqual(pdb.get(key,_refresh_ahead=200).name,'old')
+    #Only one refresh is queued while the first one holds the lease
+    pdb.get(key,_refresh_ahead=200)
+    tasks = self.taskqueue.GetTasks('default')
+    self.assertEqual(len(tasks),1)
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertEqual(pdb.get(key,_storage='memcache').name,'new')
+    
+  def test_refresh_ahead_default(self):
+    key = pdb.put(TestModel(key_name='refresh_default',name='old'),
+                  _memcache_expiration=100)
+    PerformanceEngine.REFRESH_AHEAD = 200
+    try:
+      pdb.get(key,_refresh_ahead=False)
+      self.assertEqual(len(self.taskqueue.GetTasks('default')),0)
+      pdb.get(key)
+      self.assertEqual(len(self.taskqueue.GetTasks('default')),1)
+    finally:
+      PerformanceEngine.REFRESH_AHEAD = None
+    
+class KeyCacheTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.size = PerformanceEngine.KEY_CACHE_SIZE
+    
+  def tearDown(self):
+    PerformanceEngine.KEY_CACHE_SIZE = self.size
+    self.testbed.deactivate()
+    
+  def test_key_cache(self):
+    PerformanceEngine.KEY_CACHE_SIZE = 10
+    cache = PerformanceEngine._KeyCache()
+    for i in range(25):
+      cache.set(i,str(i))
+    self.assertEqual(len(cache.current)+len(cache.previous),10)
+    self.assertEqual(cache.get(24),'24')
+    self.assertEqual(cache.get(0),None)
+    
+  def test_key_str(self):
+    key = db.Key.from_path(TestModel.kind(),'cached',TestModel.kind(),7)
+    self.assertEqual(PerformanceEngine._key_str(str(key)),str(key))
+    self.assertEqual(PerformanceEngine._key_str(str(key)),str(key))
+    self.assertEqual(PerformanceEngine._id_or_name(str(key)),'7')
+    self.assertEqual(PerformanceEngine._path_key_str(TestModel.kind(),7,key.parent()),str(key))
+    
+class LocalStatsTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    cachepy.flush()
+    pdb.enable_local_stats()
+    
+  def tearDown(self):
+    pdb.enable_local_stats(False)
+    self.testbed.deactivate()
+    
+  def test_local_stats(self):
+    before = pdb.local_stats()
+    keys = pdb.put([TestModel(key_name='stats_%s' % i) for i in range(5)],
+                   _storage='local')
+    pdb.get(keys,_storage='local')
+    pdb.get(db.Key.from_path(TestModel.kind(),'missing'),_storage='local')
+    query = pdb.GqlQuery('SELECT * FROM TestModel')
+    query.fetch(10,_cache='local')
+    query.fetch(10,_cache='local')
+    
+    stats = pdb.local_stats()
+    kind = stats['kinds'][TestModel.kind()]
+    hits = kind['hits'] - before['kinds'].get(TestModel.kind(),{}).get('hits',0)
+    self.assertEqual(hits,5)
+    self.assertEqual(kind['keys'],5)
+    self.assertTrue(kind['bytes'] > 0)
+    self.assertTrue(stats['classes']['entity']['misses'] >= 1)
+    query_stats = stats['queries'][query.key_name.split('|')[0]]
+    self.assertEqual(query_stats['keys'],1)
+    self.assertTrue(query_stats['hits'] >= 1)
+    
+  def test_local_stats_off(self):
+    pdb.enable_local_stats(False)
+    pdb.put(TestModel(key_name='stats_off'),_storage='local')
+    self.assertEqual(pdb.local_stats()['kinds'],{})
+    
+class SerializeTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    
+  def tearDown(self):
+    self.testbed.deactivate()
+    
+  def test_compression(self):
+    small = TestModel(key_name='small',name='small')
+    large = TestModel(key_name='large',name='large'*290)
+    small_data = _serialize(small)
+    large_data = _serialize(large)
+    
+    self.assertEqual(small_data[0],PerformanceEngine._RAW_HEADER)
+    self.assertEqual(large_data[0],PerformanceEngine._ZLIB_HEADER)
+    self.assertTrue(len(large_data) < len(large.name))
+    self.assertEqual(_deserialize(small_data).name,'small')
+    self.assertEqual(_deserialize([large_data])[0].name,large.name)
+    
+  def test_compression_by_kind(self):
+    PerformanceEngine.COMPRESSION_KINDS[TestModel.kind()] = (None,0)
+    try:
+      data = _serialize(TestModel(key_name='large',name='large'*290))
+      self.assertEqual(data[0],PerformanceEngine._RAW_HEADER)
+    finally:
+      del PerformanceEngine.COMPRESSION_KINDS[TestModel.kind()]
+    
+  def test_legacy_value(self):
+    model = TestModel(key_name='legacy',name='legacy')
+    data = db.model_to_protobuf(model).Encode()
+    self.assertEqual(_deserialize(data).name,'legacy')
+    
+class SnapshotTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    handle, self.path = tempfile.mkstemp()
+    os.close(handle)
+    
+  def tearDown(self):
+    os.remove(self.path)
+    self.testbed.deactivate()
+    
+  def test_snapshot_local(self):
+    keys = pdb.put([TestModel(key_name='snapshot_%s' % i,name='snapshot') 
+                    for i in range(10)],_storage='local')
+    self.assertTrue(pdb.snapshot_local(self.path) >= 10)
+    cachepy.flush()
+    
+    self.assertTrue(pdb.load_local(self.path) >= 10)
+    models = pdb.get(keys,_storage='local')
+    self.assertEqual([model.name for model in models],['snapshot']*10)
+    
+class IGetTest(unittest.TestCase):
+  
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    models = [TestModel(key_name='iget_%s' % i,name=str(i)) for i in range(25)]
+    self.keys = db.put(models)
+    pdb.put(models[:5],_storage='memcache')
+    
+  def tearDown(self):
+    self.testbed.deactivate()
+    
+  def test_iget(self):
+    keys = self.keys+[db.Key.from_path(TestModel.kind(),'iget_missing')]+self.keys[:2]
+    consumed = []
+    def key_iterator():
+      for key in keys:
+        consumed.append(key)
+        yield key
+    models = pdb.iget(key_iterator(),batch_size=10)
+    self.assertEqual(models.next().name,'0')
+    #The second window is read before the first one is consumed
+    self.assertEqual(len(consumed),20)
+    models = [models.next()]+list(models)
+    self.assertEqual([model and model.name for model in models],
+                     map(str,range(1,25))+[None,'0','1'])
+    
+    #Windows refill cache layers like pdb.get
+    self.assertEqual(pdb.get(self.keys[24],_storage='memcache').name,'24')
+    self.assertEqual(list(pdb.iget([])),[])
+    
 class DeleteTest(unittest.TestCase):
   
   def setUp(self):
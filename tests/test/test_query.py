@@ -1,8 +1,11 @@
+import base64
 import unittest
 import logging
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.ext import deferred
 from google.appengine.ext import testbed
+import PerformanceEngine
 from PerformanceEngine import pdb,cachepy,_deserialize
 from models import PdbModel
 
@@ -53,6 +56,48 @@ class QueryTest(unittest.TestCase):
     self.assertEqual(db_models[0].key(),memcache_models[0].key())
     self.assertEqual(db_models[0].key(),local_models[0].key())  
   
+  def test_fetch_chunked(self):
+    chunk_size = PerformanceEngine.MEMCACHE_CHUNK_SIZE
+    PerformanceEngine.MEMCACHE_CHUNK_SIZE = 1000
+    try:
+      db_models = self.query.fetch(100,_cache='memcache')
+      self.assertTrue(PerformanceEngine._is_manifest(memcache.get(self.query.key_name)))
+      memcache_models = self.query.fetch(100,_cache='memcache')
+    finally:
+      PerformanceEngine.MEMCACHE_CHUNK_SIZE = chunk_size
+    self.assertEqual([model.key() for model in db_models],
+                     [model.key() for model in memcache_models])
+  
+  def test_fetch_lease_timeout(self):
+    lease_wait = PerformanceEngine.LEASE_WAIT
+    PerformanceEngine.LEASE_WAIT = 0.1
+    try:
+      db_models = self.query.fetch(100)
+      memcache.add(PerformanceEngine._lease_key(self.query.key_name),1)
+      self.assertEqual(len(self.query.fetch(100,_cache='memcache')),len(db_models))
+      self.assertTrue(memcache.get(self.query.key_name) is None)
+    finally:
+      PerformanceEngine.LEASE_WAIT = lease_wait
+  
+  def test_fetch_refresh_ahead(self):
+    self.testbed.init_taskqueue_stub()
+    taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    self.assertEqual(len(self.query.fetch(200,_cache=['local','memcache'])),100)
+    db.put(PdbModel(count=100))
+    
+    #Stale local result is served and refreshed from memcache at the end of the request
+    before = pdb.stats()['local_refreshes']
+    self.assertEqual(len(self.query.fetch(200,_cache=['local','memcache'],_refresh_ahead=600)),100)
+    pdb.wait_all()
+    self.assertEqual(pdb.stats()['local_refreshes']-before,1)
+    
+    #Stale memcache result is served and refreshed by a deferred task
+    self.assertEqual(len(self.query.fetch(200,_cache='memcache',_refresh_ahead=600)),100)
+    tasks = taskqueue.GetTasks('default')
+    self.assertEqual(len(tasks),1)
+    deferred.run(base64.b64decode(tasks[0]['body']))
+    self.assertEqual(len(_deserialize(memcache.get(self.query.key_name))),101)
+  
   def test_get(self):
     db_entity = self.query.get(_cache=['local','memcache'])
     cache_key = self.query.key_name